@@ -85,7 +85,8 @@ class ArchiveDebileBridge:
 
         for aname in pkg.installed_archs:
             arch = session.query(Arch).filter_by(name=aname).one()
-            binary = Binary(source=source, arch=arch, uploaded_at=source.uploaded_at)
+            binary = Binary(source=source, arch=arch, uploaded_at=source.uploaded_at,
+                            group_suite=source.group_suite, component=source.component)
             session.add(binary)
 
             for name, arch, filename in pkg.binaries:
@@ -136,7 +137,8 @@ class ArchiveDebileBridge:
                 # Make sure debile builds the arch:all binary separately
                 check = session.query(Check).filter(Check.build == True).one()
                 job = Job(check=check, arch=arch_all,
-                          source=source, binary=None)
+                          source=source, binary=None,
+                          group_suite=source.group_suite, component=source.component)
                 session.add(job)
 
         for arch in arches:
@@ -167,7 +169,11 @@ class ArchiveDebileBridge:
             if job:
                 binary = job.new_binary(arch)
             else:
-                binary = Binary(source=source, arch=arch, uploaded_at=datetime.utcnow())
+                binary = Binary(source=source, arch=arch, uploaded_at=datetime.utcnow(),
+                                group_suite=source.group_suite, component=source.component)
+                if arch == arch_all:
+                    for job in source.jobs:
+                        job.do_indep = False
             session.add(binary)
 
             for name, arch, filename in pkg.binaries:
@@ -231,7 +237,7 @@ class ArchiveDebileBridge:
         bcheck_data = self._create_depwait_report(suite)
 
         with session() as s:
-            jobs = s.query(Job).join(Job.check).join(Job.source).join(Source.group_suite).join(GroupSuite.group).join(GroupSuite.suite).filter(
+            jobs = s.query(Job).join(Job.check).join(Job.group_suite).join(GroupSuite.group).join(GroupSuite.suite).filter(
                 Group.name == "default",
                 Suite.name == suite,
                 Check.build == True,
@@ -331,7 +337,7 @@ class ArchiveDebileBridge:
             group = s.query(Group).filter_by(name="default").one()
             path = group.files_path
 
-            dirs.update(x.directory for x in s.query(Result).join(Result.job).join(Job.source).join(Source.group_suite).filter(GroupSuite.group == group))
+            dirs.update(x.directory for x in s.query(Result).join(Result.job).join(Job.group_suite).filter(GroupSuite.group == group))
 
         old_cwd = os.getcwd()
         try:
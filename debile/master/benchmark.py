@@ -0,0 +1,234 @@
+# Copyright (c) 2026      agent <agent@local>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""
+Scheduler load benchmark: fills a scratch database with synthetic sources
+and jobs, then has simulated builders hammer get_next_job/close_job/
+forfeit_job concurrently and reports latencies and SQL statement counts.
+"""
+
+from debile.master.utils import config, session, Session, _create_engine
+from debile.master.orm import (Person, Builder, Suite, Component, Arch, Check,
+                               Group, GroupSuite, Job, Base,
+                               create_source, create_jobs)
+from debile.master.interface import NAMESPACE, DebileMasterInterface
+from debile.master.cache import names
+
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import event
+
+import threading
+import random
+import time
+
+
+ARCHES = ["amd64", "i386", "armhf", "arm64", "armel", "mips", "mipsel",
+          "powerpc", "ppc64el", "s390x"]
+
+STATS = threading.local()
+
+
+class Recorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statements = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.jobs = 0
+
+    def record(self, method, latency, statements):
+        with self.lock:
+            self.latencies[method].append(latency)
+            self.statements[method] += statements
+
+    def error(self, method):
+        with self.lock:
+            self.errors[method] += 1
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+def populate(s, args):
+    user = Person(name="Benchmark", email="benchmark@localhost", ip="127.0.0.1")
+    s.add(user)
+
+    for i in range(args.builders):
+        s.add(Builder(name="builder%d" % i, maintainer=user,
+                      ip="127.0.0.%d" % (i + 2), last_ping=datetime.utcnow()))
+
+    suite = Suite(name="unstable")
+    component = Component(name="main")
+    arches = [Arch(name=x) for x in ["source", "all"] + ARCHES[:args.arches]]
+    build = Check(name="build", source=False, binary=False, build=True)
+    checks = [Check(name="check%d" % i, source=True, binary=True, build=False)
+              for i in range(args.checks)]
+    s.add_all([suite, component, build] + arches + checks)
+
+    group_suites = []
+    for name, chained in [("flat", False), ("chained", True)]:
+        group = Group(name=name, maintainer=user)
+        gs = GroupSuite(group=group, suite=suite)
+        gs.components = [component]
+        gs.arches = arches
+        gs.checks = checks + ([build] if chained else [])
+        s.add(gs)
+        group_suites.append(gs)
+    s.flush()
+
+    for i in range(args.sources):
+        # The first --chained sources go through a build job, which blocks
+        # their binary checks.
+        gs = group_suites[1 if i < args.chained else 0]
+        dsc = {
+            "Source": "source%d" % i,
+            "Version": "1.0-1",
+            "Architecture": "any all",
+            "Maintainer": "Benchmark <benchmark@localhost>",
+        }
+        source = create_source(dsc, gs, component, user, ARCHES[:1], "any")
+        source.directory = "pool/main/s/source%d" % i
+        source.dsc_filename = "source%d_1.0-1.dsc" % i
+        create_jobs(source)
+        s.add(source)
+
+        if i % 100 == 99:
+            s.commit()
+
+
+def call(recorder, builder_id, method, *args):
+    STATS.statements = 0
+    start = time.time()
+    try:
+        with session() as s:
+            NAMESPACE.session = s
+            NAMESPACE.machine = s.query(Builder).get(builder_id)
+            NAMESPACE.user = None
+            ret = getattr(DebileMasterInterface(), method)(*args)
+    except Exception:
+        recorder.error(method)
+        return None
+    finally:
+        NAMESPACE.session = None
+        NAMESPACE.machine = None
+    recorder.record(method, time.time() - start, STATS.statements)
+    return ret
+
+
+def upload_binary(job_id):
+    # What debile-incoming does with the .changes of a build job, so the
+    # jobs blocked by it become runnable.
+    with session() as s:
+        job = s.query(Job).get(job_id)
+        s.add(job.new_binary())
+        if job.do_indep:
+            s.add(job.new_binary(s.query(Arch).filter_by(name="all").one()))
+
+
+def builder(recorder, builder_id, args, deadline):
+    suites = ["unstable"]
+    components = ["main"]
+    arches = ARCHES[:args.arches]
+    checks = ["build"] + ["check%d" % i for i in range(args.checks)]
+
+    idle = 0
+    while time.time() < deadline and idle < 3:
+        job = call(recorder, builder_id, "get_next_job",
+                   suites, components, arches, checks)
+        if job is None:
+            idle += 1
+            time.sleep(0.1)
+            continue
+        idle = 0
+
+        if random.random() < args.forfeit:
+            call(recorder, builder_id, "forfeit_job", job['id'])
+            continue
+
+        call(recorder, builder_id, "close_job", job['id'], False)
+        if job['check'] == "build":
+            upload_binary(job['id'])
+
+        with recorder.lock:
+            recorder.jobs += 1
+
+
+def main(args):
+    engine = _create_engine(args.database, None)
+    Session.configure(bind=engine)
+
+    config.update({
+        "affinity_preference": ARCHES[:1],
+        "repo": {
+            "repo_path": "/srv/debile/repo/{name}",
+            "repo_url": "http://localhost/debile/repo/{name}",
+            "files_path": "/srv/debile/files/{name}",
+            "files_url": "http://localhost/debile/files/{name}",
+        },
+    })
+
+    print("Creating %d sources on %d arches with %d checks (%d chained)..." % (
+        args.sources, args.arches, args.checks, args.chained))
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    with session() as s:
+        populate(s, args)
+        builders = [x for x, in s.query(Builder.id)]
+        names.load(s)
+        jobs = s.query(Job).count()
+    print("%d jobs queued, running %d builders for at most %d seconds..." % (
+        jobs, len(builders), args.duration))
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count_statement(*_):
+        STATS.statements = getattr(STATS, "statements", 0) + 1
+
+    recorder = Recorder()
+    deadline = time.time() + args.duration
+    threads = [threading.Thread(target=builder,
+                                args=(recorder, x, args, deadline))
+               for x in builders]
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    print("")
+    print("%-14s %8s %8s %8s %8s %8s %8s" % (
+        "method", "calls", "errors", "p50 ms", "p95 ms", "p99 ms", "sql/call"))
+    for method in ["get_next_job", "close_job", "forfeit_job"]:
+        latencies = recorder.latencies[method]
+        if not latencies:
+            continue
+        print("%-14s %8d %8d %8.1f %8.1f %8.1f %8.1f" % (
+            method, len(latencies), recorder.errors[method],
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 95) * 1000,
+            percentile(latencies, 99) * 1000,
+            float(recorder.statements[method]) / len(latencies)))
+    print("")
+    print("%d jobs completed in %.1f seconds (%.1f jobs/s)" % (
+        recorder.jobs, elapsed, recorder.jobs / elapsed))
@@ -0,0 +1,266 @@
+# Copyright (c) 2026      agent <agent@local>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from debile.master.orm import (Suite, Component, Arch, Check, Group, GroupSuite,
+                               Builder, Person, debilize_options)
+from debile.master.metrics import method_metrics
+
+from collections import OrderedDict
+from sqlalchemy import event, select, literal, union_all
+from sqlalchemy.orm import Session
+
+import threading
+import time
+
+
+class NameCache(object):
+    """
+    Process-wide name -> id maps for the suites, components, arches, checks,
+    groups and group suites, which almost never change, so the scheduler can
+    filter on ids without looking the names up on every poll.
+    """
+
+    # Unknown names trigger a reload, at most this often (in seconds), in
+    # case they were added by another process (e.g. debile-master-init).
+    REFRESH = 60
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._maps = None
+        self._loaded_at = 0
+
+    def load(self, session):
+        maps = {
+            "suites": dict(session.query(Suite.name, Suite.id)),
+            "components": dict(session.query(Component.name, Component.id)),
+            "arches": dict(session.query(Arch.name, Arch.id)),
+            "checks": dict(session.query(Check.name, Check.id)),
+            "groups": dict(session.query(Group.name, Group.id)),
+            "group_suites": {
+                (group, suite): id for id, group, suite in
+                session.query(GroupSuite.id, Group.name, Suite.name).join(
+                    GroupSuite.group).join(GroupSuite.suite)
+            },
+        }
+
+        with self._lock:
+            self._maps = maps
+            self._loaded_at = time.time()
+        return maps
+
+    def invalidate(self, session=None):
+        """
+        Drop the cached maps. If `session` is given, drop them again once it
+        commits, so changes it makes are picked up by the next load.
+        """
+
+        with self._lock:
+            self._maps = None
+        if session is not None:
+            session.info['invalidate_names'] = True
+
+    def _lookup(self, session, kind, keys):
+        maps = self._maps
+        if maps is None:
+            maps = self.load(session)
+        elif (any(x not in maps[kind] for x in keys) and
+              time.time() - self._loaded_at > self.REFRESH):
+            maps = self.load(session)
+        return [maps[kind][x] for x in keys if x in maps[kind]]
+
+    def suite_ids(self, session, names):
+        return self._lookup(session, "suites", names)
+
+    def component_ids(self, session, names):
+        return self._lookup(session, "components", names)
+
+    def arch_ids(self, session, names):
+        return self._lookup(session, "arches", names)
+
+    def check_ids(self, session, names):
+        return self._lookup(session, "checks", names)
+
+    def group_ids(self, session, names):
+        return self._lookup(session, "groups", names)
+
+    def group_suite_id(self, session, group, suite):
+        ids = self._lookup(session, "group_suites", [(group, suite)])
+        return ids[0] if ids else None
+
+
+class IdentityCache(object):
+    """
+    Process-wide SSL fingerprint (or IP address) -> builder and user map, so
+    that authenticating a request doesn't cost two searches. Only the ids
+    are cached, the rows are loaded by primary key into the request session,
+    so that columns which change all the time (like the speed and last ping
+    of builders) are never served stale.
+    """
+
+    # Entries are reloaded after this many seconds, in case the builders or
+    # users were changed by another process (e.g. debile-master-init).
+    TTL = 60
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._generation = 0
+
+    def lookup(self, session, **criteria):
+        """
+        Return the (builder, user) matching `criteria`, either of which may
+        be None, attached to `session`.
+        """
+
+        key = tuple(sorted(criteria.items()))
+        with self._lock:
+            entry = self._entries.get(key)
+            generation = self._generation
+
+        if entry is None or entry[0] < time.time():
+            identity = (session.query(Builder).filter_by(**criteria).first(),
+                        session.query(Person).filter_by(**criteria).first())
+
+            entry = (time.time() + self.TTL,
+                     tuple(None if x is None else x.id for x in identity))
+            with self._lock:
+                # Don't cache what was loaded before an invalidation.
+                if generation == self._generation:
+                    self._entries[key] = entry
+            return identity
+
+        return tuple(None if id is None else session.query(cls).get(id)
+                     for cls, id in zip((Builder, Person), entry[1]))
+
+    def invalidate(self, session=None):
+        """
+        Drop the cached identities. If `session` is given, drop them again
+        once it commits, so changes it makes are picked up.
+        """
+
+        with self._lock:
+            self._entries = {}
+            self._generation += 1
+        if session is not None:
+            session.info['invalidate_identities'] = True
+
+
+def _load(session, cls, id):
+    return session.query(cls).options(*debilize_options(cls)).get(id)
+
+
+class ResponseCache(object):
+    """
+    Process-wide LRU cache of the debilized groups, sources, binaries and
+    jobs handed out by get_group, get_source, get_binary and get_job.
+
+    An entry records the row_version of the rows it was built from (the
+    object itself and its group, source and binary), and is only used
+    while none of them changed, which a single query tells, rather than
+    loading everything debilize() shows.
+
+    The other rows an entry shows are not checked, and may be up to TTL
+    seconds stale: the builder of a job, or of the build job of a binary
+    (e.g. its last_ping, which changes with every poll and lease renewal,
+    so that checking it would defeat the cache), and the people it names
+    (maintainers, uploader).
+    """
+
+    # Maximum number of entries, and seconds after which entries are
+    # rebuilt anyway.
+    SIZE = 10000
+    TTL = 300
+
+    DEPENDENCIES = ('group', 'source', 'binary')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session, cls, id):
+        """
+        Return `session.query(cls).get(id).debilize()`, from the cache if
+        possible.
+        """
+
+        key = (cls, id)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+        # Checked in `session`, so that it sees its own changes, e.g. those
+        # made earlier in a system.multicall.
+        if (entry is not None and entry[0] > now and
+                _row_versions(session, entry[1]) == entry[2]):
+            with self._lock:
+                self._entries[key] = entry
+                self.hits += 1
+            return entry[3]
+
+        with self._lock:
+            self.misses += 1
+
+        obj = _load(session, cls, id)
+        objs = [obj] + [getattr(obj, x, None) for x in self.DEPENDENCIES]
+        objs = [x for x in objs if x is not None]
+        rows = [(type(x), x.id) for x in objs]
+        versions = [x.row_version for x in objs]
+        payload = obj.debilize()
+
+        with self._lock:
+            self._entries[key] = (now + self.TTL, rows, versions, payload)
+            while len(self._entries) > self.SIZE:
+                self._entries.popitem(last=False)
+        return payload
+
+
+def _row_versions(session, rows):
+    # The current row_version of each (class, id) of `rows`, None for the
+    # deleted ones, in one query.
+    query = union_all(*[
+        select([literal(i), cls.__table__.c.row_version]).where(
+            cls.__table__.c.id == id)
+        for i, (cls, id) in enumerate(rows)])
+    versions = dict(session.execute(query).fetchall())
+    return [versions.get(i) for i in range(len(rows))]
+
+
+names = NameCache()
+identities = IdentityCache()
+responses = ResponseCache()
+
+method_metrics.add_counter(
+    "debile_response_cache_hits_total",
+    "Reads of groups, sources, binaries and jobs from the cache.",
+    lambda: responses.hits)
+method_metrics.add_counter(
+    "debile_response_cache_misses_total",
+    "Reads of groups, sources, binaries and jobs from the database.",
+    lambda: responses.misses)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_caches(session):
+    if session.info.pop('invalidate_names', False):
+        names.invalidate()
+    if session.info.pop('invalidate_identities', False):
+        identities.invalidate()
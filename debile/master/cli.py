@@ -39,6 +39,20 @@ def init():
     main(args, config)
 
 
+def migrate():
+    parser = ArgumentParser(description="Debile master database migration")
+    parser.add_argument("--config", action="store", dest="config", default=None,
+                        help="Path to the master.yaml config file.")
+    parser.add_argument("--runnable", action="store_true", dest="runnable", default=False,
+                        help="Recompute the runnable jobs, e.g. after changing the scheduler settings.")
+
+    args = parser.parse_args()
+    config = init_master(args.config)
+
+    from debile.master.migrate import main
+    main(args, config)
+
+
 def process_incoming():
     parser = ArgumentParser(description="Debile master incoming handling")
     parser.add_argument("--config", action="store", dest="config", default=None,
@@ -75,3 +89,28 @@ def server():
 
     from debile.master.server import main
     main(args, config)
+
+
+def benchmark():
+    parser = ArgumentParser(description="Debile master scheduler benchmark")
+    parser.add_argument("--sources", action="store", dest="sources", type=int, default=1000,
+                        help="Number of sources to create.")
+    parser.add_argument("--arches", action="store", dest="arches", type=int, default=2,
+                        help="Number of architectures (at most 10).")
+    parser.add_argument("--checks", action="store", dest="checks", type=int, default=2,
+                        help="Number of source/binary checks.")
+    parser.add_argument("--chained", action="store", dest="chained", type=int, default=100,
+                        help="Number of sources whose binary checks depend on a build job.")
+    parser.add_argument("--builders", action="store", dest="builders", type=int, default=8,
+                        help="Number of concurrent simulated builders.")
+    parser.add_argument("--forfeit", action="store", dest="forfeit", type=float, default=0.05,
+                        help="Fraction of jobs the builders forfeit instead of closing.")
+    parser.add_argument("--duration", action="store", dest="duration", type=int, default=60,
+                        help="Stop after this many seconds.")
+    parser.add_argument("database", action="store",
+                        help="SQLAlchemy URL of a scratch database, its content is DESTROYED.")
+
+    args = parser.parse_args()
+
+    from debile.master.benchmark import main
+    main(args)
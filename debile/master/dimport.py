@@ -23,6 +23,7 @@ from datetime import datetime
 from sqlalchemy.sql import exists
 
 from debile.master.utils import session
+from debile.master.cache import names, identities
 from debile.master.orm import (Person, Builder, Suite, Component, Arch, Check,
                                Group, GroupSuite, Base)
 
@@ -133,6 +134,9 @@ def dimport(args, s):
         if not sane and not args.force:
             raise Exception("Sanity checks failed, use --force to override")
 
+    names.invalidate(s)
+    identities.invalidate(s)
+
 
 def main(args, config):
     with session() as s:
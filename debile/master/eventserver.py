@@ -0,0 +1,345 @@
+# Copyright (c) 2026      agent <agent@local>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""
+Event-driven XML-RPC server: a single thread multiplexes every connection
+(accepting, TLS handshakes, reading requests and writing responses), and
+only complete requests are handed to a bounded pool of worker threads,
+which do the database work.
+"""
+
+from SimpleXMLRPCServer import SimpleXMLRPCDispatcher, SimpleXMLRPCRequestHandler
+from xmlrpclib import gzip_encode, gzip_decode
+
+from debile.master.utils import session
+from debile.master.interface import NAMESPACE, DebileMasterInterface
+from debile.master.server import (authenticate, cert_fingerprint, check_shutdown,
+                                  http_response, make_ssl_context, RETRY_AFTER,
+                                  SavepointMulticallMixIn, JSONRPCMixIn,
+                                  DebileRequestHandler)
+from debile.master.workers import WorkerPool, WORKERS, BACKLOG
+
+from collections import deque
+
+import asyncore
+import threading
+import logging
+import socket
+import errno
+import ssl
+import os
+
+
+# Requests with larger headers or bodies are refused.
+MAX_HEADER = 64 * 1024
+MAX_BODY = 64 * 1024 * 1024
+
+# Larger responses are compressed for clients accepting gzip, like the
+# threaded servers do.
+ENCODE_THRESHOLD = SimpleXMLRPCRequestHandler.encode_threshold
+
+_WOULDBLOCK = (errno.EWOULDBLOCK, errno.EAGAIN, errno.EINTR)
+_SSL_WANT = (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE)
+
+
+class Waker(asyncore.file_dispatcher):
+    """
+    Runs callbacks posted by the workers in the event loop thread, which is
+    the only one allowed to touch the connections.
+    """
+
+    def __init__(self, map):
+        self.reader, self.writer = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self.reader, map=map)
+        self.lock = threading.Lock()
+        self.callbacks = deque()
+
+    def post(self, fn, *args):
+        with self.lock:
+            self.callbacks.append((fn, args))
+        os.write(self.writer, "x")
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        while True:
+            with self.lock:
+                if not self.callbacks:
+                    return
+                fn, args = self.callbacks.popleft()
+            try:
+                fn(*args)
+            except Exception:
+                logging.getLogger('debile').warning(
+                    "Error in event loop callback", exc_info=True)
+
+
+class RPCChannel(asyncore.dispatcher):
+    """
+    One client connection. Reads HTTP requests, one at a time, passes them
+    to the server and writes back the responses, keeping the connection
+    open between requests unless the client asks otherwise.
+    """
+
+    def __init__(self, server, sock, address):
+        asyncore.dispatcher.__init__(self, sock, map=server.map)
+        self.server = server
+        self.address = address
+        self.inbuf = ""
+        self.outbuf = ""
+        self.busy = False
+        self.closing = False
+        self.fingerprint = None
+        self.handshaking = isinstance(sock, ssl.SSLSocket)
+        self.want_write = False
+
+    def readable(self):
+        return self.handshaking or not (self.busy or self.outbuf or self.closing)
+
+    def writable(self):
+        if self.handshaking:
+            return self.want_write
+        return bool(self.outbuf)
+
+    def handle_read(self):
+        if self.handshaking:
+            return self._handshake()
+
+        data = self._io(self.socket.recv, 65536)
+        if data is None:
+            return
+        if not data:
+            return self.handle_close()
+
+        self.inbuf += data
+        if self.fingerprint is not None:
+            # Decrypted data select() doesn't know about.
+            while self.socket.pending():
+                self.inbuf += self.socket.recv(self.socket.pending())
+        self._parse()
+
+    def handle_write(self):
+        if self.handshaking:
+            return self._handshake()
+
+        sent = self._io(self.socket.send, self.outbuf)
+        if not sent:
+            return
+        self.outbuf = self.outbuf[sent:]
+
+        if not self.outbuf:
+            if self.closing:
+                self.close()
+            elif self.inbuf:
+                self._parse()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        logging.getLogger('debile').debug(
+            "Error on connection from %s", self.address, exc_info=True)
+        self.close()
+
+    def _io(self, method, arg):
+        # Returns None if the socket isn't ready after all, and "" if the
+        # peer went away.
+        try:
+            return method(arg)
+        except ssl.SSLError as e:
+            if e.args[0] in _SSL_WANT:
+                return None
+            raise
+        except socket.error as e:
+            if e.args[0] in _WOULDBLOCK:
+                return None
+            if e.args[0] in asyncore._DISCONNECTED:
+                self.handle_close()
+                return None
+            raise
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError as e:
+            if e.args[0] not in _SSL_WANT:
+                raise
+            self.want_write = e.args[0] == ssl.SSL_ERROR_WANT_WRITE
+            return
+
+        self.handshaking = False
+        self.fingerprint = cert_fingerprint(self.socket)
+
+    def _parse(self):
+        end = self.inbuf.find("\r\n\r\n")
+        if end < 0:
+            if len(self.inbuf) > MAX_HEADER:
+                self.respond(http_response(413, keep_alive=False), False)
+            return
+
+        lines = self.inbuf[:end].split("\r\n")
+        try:
+            method, path, version = lines[0].split()
+            headers = dict((k.strip().lower(), v.strip()) for k, v in
+                           (x.split(":", 1) for x in lines[1:]))
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            return self.respond(http_response(400, keep_alive=False), False)
+
+        if method != "POST":
+            return self.respond(http_response(501, keep_alive=False), False)
+        if path not in DebileRequestHandler.rpc_paths:
+            return self.respond(http_response(404, keep_alive=False), False)
+        if length > MAX_BODY:
+            return self.respond(http_response(413, keep_alive=False), False)
+
+        if len(self.inbuf) < end + 4 + length:
+            return
+        body = self.inbuf[end + 4:end + 4 + length]
+        self.inbuf = self.inbuf[end + 4 + length:]
+
+        keep_alive = (version == "HTTP/1.1" and
+                      headers.get("connection", "").lower() != "close")
+        encoding = headers.get("content-encoding", "identity").lower()
+        accept_gzip = "gzip" in headers.get("accept-encoding", "")
+
+        self.busy = True
+        if not self.server.pool.submit(self.server.process, self, path, body,
+                                       encoding, accept_gzip, keep_alive):
+            self.respond(http_response(503, headers=[("Retry-After", RETRY_AFTER)],
+                                       keep_alive=keep_alive), keep_alive)
+
+    def respond(self, response, keep_alive):
+        if not self.connected:
+            return
+        self.busy = False
+        self.closing = not keep_alive
+        self.outbuf += response
+
+
+class EventXMLRPCServer(SavepointMulticallMixIn, JSONRPCMixIn,
+                        asyncore.dispatcher, SimpleXMLRPCDispatcher):
+    """
+    Serves the DebileMasterInterface over XML-RPC like the threaded servers
+    in debile.master.server, but can hold thousands of (mostly idle, or
+    TLS handshaking) connections with a fixed number of threads.
+
+    Note that long polls (get_next_job with a wait) hold a worker while
+    they wait, so `workers` should exceed the number of builders using
+    them, or the long_poll max_wait should be kept short.
+    """
+
+    def __init__(self, addr, keyfile=None, certfile=None, ca_certs=None,
+                 workers=WORKERS, backlog=BACKLOG, allow_none=False,
+                 encoding=None):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        SimpleXMLRPCDispatcher.__init__(self, allow_none, encoding)
+
+        self.ssl_context = None
+        if certfile is not None:
+            self.ssl_context = make_ssl_context(keyfile, certfile, ca_certs)
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(addr)
+        self.listen(socket.SOMAXCONN)
+
+        self.pool = WorkerPool(workers, backlog, name="xmlrpc")
+        self.waker = Waker(self.map)
+        self.stopping = False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, address = pair
+
+        if self.ssl_context is not None:
+            # The handshake is done by the channel, in the event loop.
+            sock = self.ssl_context.wrap_socket(sock, server_side=True,
+                                                do_handshake_on_connect=False)
+        RPCChannel(self, sock, address)
+
+    def handle_error(self):
+        # Keep listening whatever happened to that one connection.
+        logging.getLogger('debile').warning(
+            "Error while accepting a connection", exc_info=True)
+
+    def process(self, channel, path, body, encoding, accept_gzip, keep_alive):
+        # Runs in a worker thread.
+        try:
+            if encoding == "gzip":
+                body = gzip_decode(body)
+            elif encoding != "identity":
+                raise ValueError("Unsupported content encoding: %s" % (encoding))
+        except ValueError:
+            self.waker.post(channel.respond, http_response(400, keep_alive=False), False)
+            return
+
+        try:
+            with session() as s:
+                NAMESPACE.session = s
+                if channel.fingerprint is not None:
+                    identity = authenticate(fingerprint=channel.fingerprint)
+                else:
+                    identity = authenticate(address=channel.address[0])
+
+                if identity:
+                    payload = self._marshaled_dispatch(body, None, path)
+                    headers = []
+                    if accept_gzip and len(payload) > ENCODE_THRESHOLD:
+                        payload = gzip_encode(payload)
+                        headers.append(("Content-Encoding", "gzip"))
+                    response = http_response(200, payload, headers,
+                                             keep_alive=keep_alive, path=path)
+                else:
+                    response = http_response(401, keep_alive=False)
+                    keep_alive = False
+        except Exception:
+            logging.getLogger('debile').warning(
+                "Error while processing xmlrpc request", exc_info=True)
+            response = http_response(500, keep_alive=False)
+            keep_alive = False
+        finally:
+            NAMESPACE.session = None
+            NAMESPACE.machine = None
+            NAMESPACE.user = None
+
+        self.waker.post(channel.respond, response, keep_alive)
+
+        if DebileMasterInterface.shutdown_request:
+            try:
+                check_shutdown()
+            except SystemExit:
+                self.waker.post(self.stop)
+
+    def stop(self):
+        self.stopping = True
+
+    def serve_forever(self):
+        while not self.stopping:
+            asyncore.loop(timeout=1, use_poll=True, map=self.map, count=1)
+        raise SystemExit(0)
@@ -28,6 +28,7 @@ from debile.master.utils import emit
 from debile.master.dud import Dud, DudFileException
 from debile.master.filerepo import FileRepo, FilesAlreadyRegistered
 from debile.master.orm import Builder, Job
+from debile.master.scheduler import record_job_stat
 
 
 def process_dud(config, session, path):
@@ -105,6 +106,9 @@ def accept_dud(config, session, dud, builder):
     result = job.new_result(fire, failed)
     session.add(result)
 
+    if fire.metadata.stats is not None:
+        record_job_stat(session, job, fire.metadata.stats.wallclocktime)
+
     try:
         repo = FileRepo()
         repo.add_dud(result.path, dud, config['filerepo_chmod_mode'])
@@ -20,10 +20,15 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
-from debile.master.orm import (Person, Builder, Suite, Component, Arch, Check,
-                               Group, GroupSuite, Source, Binary, Job)
+from debile.master.orm import (Person, Builder, Suite, Check,
+                               Group, GroupSuite, Source, Binary, Job,
+                               debilize_options)
 from debile.master.keyrings import import_pgp, import_ssl, clean_ssl_keyring
-from debile.master.utils import emit
+from debile.master.cache import names, identities, responses
+from debile.master.scheduler import (wait_for_jobs, jobs_per_poll, poll_wait,
+                                     lease_expiry, record_job_stat)
+from debile.master.utils import emit, replica_session
+from debile.master.metrics import method_metrics
 
 from debian.debian_support import Version
 from datetime import datetime, timedelta
@@ -35,40 +40,58 @@ import logging
 NAMESPACE = threading.local()
 
 
+def _call(fn, args, kwargs):
+    try:
+        return fn(*args, **kwargs)
+    except:
+        logger = logging.getLogger('debile')
+        logger.debug("Caught exception when processing xmlrpc request.", exc_info=True)
+        raise
+
+
 def generic_method(fn):
     def _(*args, **kwargs):
-        try:
-            return fn(*args, **kwargs)
-        except:
-            logger = logging.getLogger('debile')
-            logger.debug("Caught exception when processing xmlrpc request.", exc_info=True)
-            raise
+        with method_metrics.measure(fn.__name__):
+            return _call(fn, args, kwargs)
     return _
 
 
 def builder_method(fn):
     def _(*args, **kwargs):
-        if not NAMESPACE.machine:
-            raise Exception("You can't do that")
-        try:
-            return fn(*args, **kwargs)
-        except:
-            logger = logging.getLogger('debile')
-            logger.debug("Caught exception when processing xmlrpc request.", exc_info=True)
-            raise
+        with method_metrics.measure(fn.__name__):
+            if not NAMESPACE.machine:
+                raise Exception("You can't do that")
+            return _call(fn, args, kwargs)
     return _
 
 
 def user_method(fn):
     def _(*args, **kwargs):
-        if not NAMESPACE.user:
-            raise Exception("You can't do that")
-        try:
-            return fn(*args, **kwargs)
-        except:
-            logger = logging.getLogger('debile')
-            logger.debug("Caught exception when processing xmlrpc request.", exc_info=True)
-            raise
+        with method_metrics.measure(fn.__name__):
+            if not NAMESPACE.user:
+                raise Exception("You can't do that")
+            return _call(fn, args, kwargs)
+    return _
+
+
+def read_only_method(fn):
+    """
+    Runs a method which only reads on the database_replica, if there is
+    one, so that it doesn't compete with job dispatch on the primary.
+    """
+
+    def _(*args, **kwargs):
+        primary = NAMESPACE.session
+        with replica_session(primary) as s:
+            if s is None:
+                return fn(*args, **kwargs)
+
+            NAMESPACE.session = s
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                NAMESPACE.session = primary
+    _.__name__ = fn.__name__
     return _
 
 
@@ -103,77 +126,157 @@ class DebileMasterInterface(object):
     # The following trio of methods handle the job control.
 
     @builder_method
-    def get_next_job(self, suites, components, arches, checks):
-        NAMESPACE.machine.last_ping = datetime.utcnow()
+    def get_next_job(self, suites, components, arches, checks, wait=0):
+        """
+        :param int wait: seconds to wait for a job if there is nothing to do
+        """
 
-        if self.__class__.shutdown_request:
-            return None
+        jobs = self._get_next_jobs(suites, components, arches, checks, 1, wait)
+        return jobs[0] if jobs else None
 
-        arches = [x for x in arches if x not in ["source", "all"]]
-        job = NAMESPACE.session.query(Job).join(Job.source).join(Source.group_suite).filter(
-            ~Job.depedencies.any(),
-            Job.dose_report == None,
-            Job.assigned_at == None,
-            Job.finished_at == None,
-            Job.failed.is_(None),
-            GroupSuite.suite.has(Suite.name.in_(suites)),
-            Source.component.has(Component.name.in_(components)),
-            (Job.arch.has(Arch.name.in_(arches)) |
-             (Job.arch.has(Arch.name.in_(["source", "all"])) &
-              Source.affinity.has(Arch.name.in_(arches)))),
-            Job.check.has(Check.name.in_(checks)),
-        ).order_by(
-            Job.assigned_count.asc(),
-            Source.uploaded_at.asc(),
-        ).first()
-
-        if job is None:
-            return None
-
-        job.assigned_count += 1
-        job.assigned_at = datetime.utcnow()
-        job.builder = NAMESPACE.machine
-
-        emit('start', 'job', job.debilize())
+    @builder_method
+    def close_job(self, job_id, failed):
+        return self._close_jobs([(job_id, failed)])
 
-        return job.debilize()
+    @builder_method
+    def forfeit_job(self, job_id):
+        return self._forfeit_jobs([job_id])
 
     @builder_method
-    def close_job(self, job_id, failed):
-        job = NAMESPACE.session.query(Job).get(job_id)
-        job.finished_at = datetime.utcnow()
+    def renew_lease(self, job_id):
+        """
+        Heartbeat sent by builders while they work on a job. Returns False if
+        the job is no longer assigned to the caller.
+        """
 
-        emit('complete', 'job', job.debilize())
+        NAMESPACE.machine.last_ping = datetime.utcnow()
+
+        job = NAMESPACE.session.query(Job).get(job_id)
+        if (job is None or job.builder != NAMESPACE.machine or
+                job.assigned_at is None or job.finished_at is not None):
+            return False
 
+        job.lease_expires_at = lease_expiry()
         return True
 
+    # Batched versions of the above, for builders running several jobs at
+    # once.
+
     @builder_method
-    def forfeit_job(self, job_id):
-        job = NAMESPACE.session.query(Job).get(job_id)
-        job.assigned_at = None
-        job.builder = None
+    def get_next_jobs(self, suites, components, arches, checks, count, wait=0):
+        return self._get_next_jobs(suites, components, arches, checks,
+                                   jobs_per_poll(count), wait)
 
-        emit('abort', 'job', job.debilize())
+    @builder_method
+    def close_jobs(self, jobs):
+        """
+        :param list jobs: (job_id, failed) pairs, as passed to close_job
 
-        return True
+        Returns False if some of the jobs were not running on the caller
+        (anymore), those are not closed.
+        """
+
+        return self._close_jobs(jobs)
+
+    @builder_method
+    def forfeit_jobs(self, job_ids):
+        """
+        Returns False if some of the jobs were not running on the caller
+        (anymore), those are left alone.
+        """
+
+        return self._forfeit_jobs(job_ids)
+
+    # The work shared by the single and batched job control methods, which
+    # are measured on their own.
+
+    def _get_next_jobs(self, suites, components, arches, checks, count, wait):
+        wait = poll_wait(wait)
+        NAMESPACE.machine.last_ping = datetime.utcnow()
+
+        if self.__class__.shutdown_request:
+            return []
+
+        jobs = wait_for_jobs(NAMESPACE.session, NAMESPACE.machine,
+                             suites, components, arches, checks, count, wait)
+        if jobs:
+            # Fills in what debilize() reads on the claimed jobs.
+            NAMESPACE.session.query(Job).options(
+                *debilize_options(Job)
+            ).filter(Job.id.in_([x.id for x in jobs])).all()
+
+        for job in jobs:
+            emit('start', 'job', job.debilize())
+
+        return [job.debilize() for job in jobs]
+
+    def _running_jobs(self, job_ids):
+        """
+        The jobs among `job_ids` which the calling builder is running. The
+        others may have had their lease reaped and been handed out to
+        another builder since, they are left alone.
+        """
+
+        jobs = NAMESPACE.session.query(Job).options(
+            *debilize_options(Job)
+        ).filter(
+            Job.id.in_(job_ids),
+            Job.builder == NAMESPACE.machine,
+            Job.assigned_at != None,
+            Job.finished_at == None,
+        ).all()
+
+        lost = set(job_ids) - set(x.id for x in jobs)
+        if lost:
+            logger = logging.getLogger('debile')
+            logger.warn("Builder %s is not running the jobs %s",
+                        NAMESPACE.machine.name, sorted(lost))
+        return jobs
+
+    def _close_jobs(self, jobs):
+        job_ids = [job_id for job_id, failed in jobs]
+        running = self._running_jobs(job_ids)
+        for job in running:
+            job.finished_at = datetime.utcnow()
+            job.lease_expires_at = None
+            record_job_stat(NAMESPACE.session, job)
+
+            emit('complete', 'job', job.debilize())
+
+        return len(running) == len(set(job_ids))
+
+    def _forfeit_jobs(self, job_ids):
+        running = self._running_jobs(job_ids)
+        for job in running:
+            job.assigned_at = None
+            job.lease_expires_at = None
+            job.builder = None
+
+            emit('abort', 'job', job.debilize())
+
+        return len(running) == len(set(job_ids))
 
     # Useful methods below.
 
     @generic_method
+    @read_only_method
     def get_group(self, group_id):
-        return NAMESPACE.session.query(Group).get(group_id).debilize()
+        return responses.get(NAMESPACE.session, Group, group_id)
 
     @generic_method
+    @read_only_method
     def get_source(self, source_id):
-        return NAMESPACE.session.query(Source).get(source_id).debilize()
+        return responses.get(NAMESPACE.session, Source, source_id)
 
     @generic_method
+    @read_only_method
     def get_binary(self, binary_id):
-        return NAMESPACE.session.query(Binary).get(binary_id).debilize()
+        return responses.get(NAMESPACE.session, Binary, binary_id)
 
     @generic_method
+    @read_only_method
     def get_job(self, job_id):
-        return NAMESPACE.session.query(Job).get(job_id).debilize()
+        return responses.get(NAMESPACE.session, Job, job_id)
 
     # Creating builders/users
 
@@ -203,6 +306,7 @@ class DebileMasterInterface(object):
             raise ValueError("Need either ssl certificate or ip address")
 
         NAMESPACE.session.add(b)
+        identities.invalidate(NAMESPACE.session)
 
         emit('create', 'slave', b.debilize())
         return b.debilize()
@@ -221,6 +325,7 @@ class DebileMasterInterface(object):
         builder.ssl = import_ssl(self.ssl_keyring, ssl, builder.name)
 
         clean_ssl_keyring(self.ssl_keyring, NAMESPACE.session)
+        identities.invalidate(NAMESPACE.session)
 
         return builder.debilize()
 
@@ -238,6 +343,7 @@ class DebileMasterInterface(object):
         builder.ssl = "0000000000000000DEADBEEF0000000000000000"
 
         clean_ssl_keyring(self.ssl_keyring, NAMESPACE.session)
+        identities.invalidate(NAMESPACE.session)
 
         return builder.debilize()
 
@@ -253,6 +359,7 @@ class DebileMasterInterface(object):
 
         p = Person(name=name, email=email, pgp=pgp, ssl=ssl, ip=ip)
         NAMESPACE.session.add(p)
+        identities.invalidate(NAMESPACE.session)
 
         emit('create', 'user', p.debilize())
         return p.debilize()
@@ -271,6 +378,7 @@ class DebileMasterInterface(object):
         user.ssl = import_ssl(self.ssl_keyring, ssl, user.name, user.email)
 
         clean_ssl_keyring(self.ssl_keyring, NAMESPACE.session)
+        identities.invalidate(NAMESPACE.session)
 
         return user.debilize()
 
@@ -288,6 +396,7 @@ class DebileMasterInterface(object):
         user.ssl = "0000000000000000DEADBEEF0000000000000000"
 
         clean_ssl_keyring(self.ssl_keyring, NAMESPACE.session)
+        identities.invalidate(NAMESPACE.session)
 
         return user.debilize()
 
@@ -383,6 +492,7 @@ class DebileMasterInterface(object):
         check.binary = is_binary
         check.build = is_build
         NAMESPACE.session.add(check)
+        names.invalidate(NAMESPACE.session)
         return check.debilize()
 
     @user_method
@@ -414,9 +524,11 @@ class DebileMasterInterface(object):
 
         gs = gs_query.one()
         gs.checks.append(check_query.one())
+        names.invalidate(NAMESPACE.session)
         return 'Check %s added to %s.' % (check, gs)
 
     @user_method
+    @read_only_method
     def list_checks(self, *args):
         # FIXME: return an user-friendly table
         # FIXME: list groups/suites the checks are enabled for
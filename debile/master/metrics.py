@@ -0,0 +1,204 @@
+# Copyright (c) 2026      agent <agent@local>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""
+Per-method metrics of the DebileMasterInterface (calls, errors, latency
+and SQL statements), served in the Prometheus text format.
+"""
+
+from debile.master.utils import pool_stats
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import threading
+import logging
+import time
+
+
+# Upper bounds of the latency histogram buckets, in seconds. Long polls
+# (get_next_job with a wait) end up in the last ones.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+_statements = threading.local()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_statement(*args):
+    _statements.count = getattr(_statements, "count", 0) + 1
+
+
+def statement_count():
+    """
+    Number of SQL statements run by the current thread so far.
+    """
+    return getattr(_statements, "count", 0)
+
+
+class MethodStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.statements = 0
+        self.duration = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def record(self, duration, statements, failed):
+        self.calls += 1
+        self.errors += failed
+        self.statements += statements
+        self.duration += duration
+        for i, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                self.buckets[i] += 1
+                break
+
+
+class MethodMetrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+        self.counters = []
+
+    def add_counter(self, name, doc, value):
+        """
+        Also export the counter `name', whose value `value()' returns.
+        """
+        self.counters.append((name, doc, value))
+
+    @contextmanager
+    def measure(self, method):
+        """
+        Records a call of `method' for the duration of the block, which
+        failed if it raises.
+        """
+
+        start = time.time()
+        statements = statement_count()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            duration = time.time() - start
+            statements = statement_count() - statements
+            with self.lock:
+                stats = self.methods.get(method)
+                if stats is None:
+                    stats = self.methods[method] = MethodStats()
+                stats.record(duration, statements, failed)
+
+    def render(self):
+        """
+        All the metrics, in the Prometheus text exposition format.
+        """
+
+        with self.lock:
+            methods = sorted((name, dict(vars(stats)))
+                             for name, stats in self.methods.items())
+
+        lines = []
+
+        def metric(name, kind, doc, samples):
+            lines.append("# HELP %s %s" % (name, doc))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for suffix, labels, value in samples:
+                if labels:
+                    suffix += "{%s}" % ",".join('%s="%s"' % x for x in labels)
+                lines.append("%s%s %s" % (name, suffix, value))
+
+        metric("debile_rpc_calls_total", "counter",
+               "Calls of each master RPC method.",
+               [("", [("method", x)], s['calls']) for x, s in methods])
+        metric("debile_rpc_errors_total", "counter",
+               "Calls of each master RPC method which raised.",
+               [("", [("method", x)], s['errors']) for x, s in methods])
+        metric("debile_rpc_queries_total", "counter",
+               "SQL statements run by each master RPC method.",
+               [("", [("method", x)], s['statements']) for x, s in methods])
+
+        samples = []
+        for name, stats in methods:
+            count = 0
+            for bound, n in zip(BUCKETS, stats['buckets']):
+                count += n
+                samples.append(("_bucket", [("method", name), ("le", bound)],
+                                count))
+            samples.append(("_bucket", [("method", name), ("le", "+Inf")],
+                            stats['calls']))
+            samples.append(("_sum", [("method", name)], stats['duration']))
+            samples.append(("_count", [("method", name)], stats['calls']))
+        metric("debile_rpc_duration_seconds", "histogram",
+               "Time spent in each master RPC method.", samples)
+
+        for name, doc, value in self.counters:
+            metric(name, "counter", doc, [("", [], value())])
+
+        return "\n".join(lines) + "\n"
+
+
+method_metrics = MethodMetrics()
+
+# Only counted when database_pool is set.
+method_metrics.add_counter("debile_db_pool_checkouts_total",
+                           "Database connections checked out of the pool.",
+                           lambda: pool_stats.checkouts)
+method_metrics.add_counter("debile_db_pool_wait_seconds_total",
+                           "Time spent waiting for database connections.",
+                           lambda: pool_stats.wait)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = method_metrics.render()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(threading.Thread):
+    """
+    Serves the metrics on http://addr:port/metrics, for Prometheus to
+    scrape.
+    """
+
+    def __init__(self, addr, port):
+        threading.Thread.__init__(self, name="metrics")
+        self.daemon = True
+        self.httpd = HTTPServer((addr, port), MetricsRequestHandler)
+
+    def run(self):
+        logger = logging.getLogger('debile')
+        logger.info("Serving metrics on `{0}' on port `{1}'".format(
+            *self.httpd.server_address))
+        self.httpd.serve_forever()
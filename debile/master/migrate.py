@@ -0,0 +1,222 @@
+# Copyright (c) 2026      agent <agent@local>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""
+Brings an existing master database up to date with the models: missing
+tables, columns and indexes are created, and the runnable jobs are
+recomputed when needed. `create_all', which debile-master-init runs, only
+creates missing tables.
+"""
+
+from debile.master.utils import session
+from debile.master.orm import (Base, Job, RunnableJob, Source, Binary, Arch,
+                               Check)
+from debile.master.scheduler import lease_expiry
+
+from sqlalchemy import inspect, literal, select, exists, and_
+
+
+# Jobs updated per transaction when (re)filling runnable_jobs
+CHUNK = 500
+
+
+def _from_source(name):
+    sources = Source.__table__
+    return lambda table: select([sources.c[name]]).where(
+        sources.c.id == table.c.source_id).as_scalar()
+
+
+def _do_indep(table):
+    checks, sources, binaries, arches = (
+        x.__table__ for x in (Check, Source, Binary, Arch))
+    return and_(
+        exists().where(and_(checks.c.id == table.c.check_id,
+                            checks.c.build)),
+        exists().where(and_(sources.c.id == table.c.source_id,
+                            sources.c.affinity_id == table.c.arch_id)),
+        ~exists().where(and_(binaries.c.source_id == table.c.source_id,
+                             binaries.c.arch_id == arches.c.id,
+                             arches.c.name == "all")),
+    )
+
+
+# How to fill the columns added to existing rows which have no constant
+# default, by (table, column).
+BACKFILLS = {
+    ('binaries', 'group_suite_id'): _from_source('group_suite_id'),
+    ('binaries', 'component_id'): _from_source('component_id'),
+    ('jobs', 'group_suite_id'): _from_source('group_suite_id'),
+    ('jobs', 'component_id'): _from_source('component_id'),
+    ('jobs', 'do_indep'): _do_indep,
+}
+
+
+def _column_ddl(engine, column, nullable):
+    preparer = engine.dialect.identifier_preparer
+    ddl = "%s %s" % (preparer.format_column(column),
+                     column.type.compile(dialect=engine.dialect))
+
+    for fk in column.foreign_keys:
+        ddl += " REFERENCES %s (%s)" % (
+            preparer.format_table(fk.column.table),
+            preparer.format_column(fk.column))
+        if fk.ondelete:
+            ddl += " ON DELETE %s" % (fk.ondelete)
+
+    default = None
+    if column.default is not None and column.default.is_scalar:
+        default = column.default.arg
+    if default is not None:
+        ddl += " DEFAULT %s" % (literal(default, column.type).compile(
+            dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+
+    if not nullable:
+        if default is None:
+            raise ValueError("Can't add the NOT NULL column %s.%s, it has no "
+                             "default" % (column.table.name, column.name))
+        ddl += " NOT NULL"
+
+    return ddl
+
+
+def _missing_columns(inspector, table):
+    present = set(x['name'] for x in inspector.get_columns(table.name))
+    return [x for x in table.columns if x.name not in present]
+
+
+def create_tables(engine, existing):
+    created = [x for x in Base.metadata.sorted_tables if x.name not in existing]
+    Base.metadata.create_all(engine)
+    for table in created:
+        print "Created table '%s'" % (table.name)
+    return [x.name for x in created]
+
+
+def add_columns(engine, existing):
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing:
+            continue
+
+        for column in _missing_columns(inspector, table):
+            backfill = BACKFILLS.get((table.name, column.name))
+            nullable = column.nullable or backfill is not None
+            engine.execute("ALTER TABLE %s ADD COLUMN %s" % (
+                preparer.format_table(table),
+                _column_ddl(engine, column, nullable)))
+            print "Added column '%s.%s'" % (table.name, column.name)
+
+            if backfill is None:
+                continue
+
+            engine.execute(table.update().values({column: backfill(table)}))
+            # SQLite can't alter columns, they stay nullable there.
+            if not column.nullable and engine.dialect.name == "postgresql":
+                engine.execute("ALTER TABLE %s ALTER COLUMN %s SET NOT NULL" % (
+                    preparer.format_table(table),
+                    preparer.format_column(column)))
+
+
+def create_indexes(engine):
+    inspector = inspect(engine)
+
+    for table in Base.metadata.sorted_tables:
+        present = set(x['name'] for x in inspector.get_indexes(table.name))
+        for index in sorted(table.indexes, key=lambda x: x.name):
+            if index.name in present:
+                continue
+
+            index.create(bind=engine)
+            print "Created index '%s'" % (index.name)
+
+
+def fill_runnable_jobs(s):
+    """
+    Recomputes runnable_jobs from the jobs, e.g. after the scheduler
+    settings the priorities come from changed.
+    """
+
+    s.query(RunnableJob).delete(synchronize_session=False)
+    s.commit()
+
+    ids = [x for x, in s.query(Job.id).filter(
+        Job.assigned_at == None,
+        Job.finished_at == None,
+        Job.failed == None,
+    ).order_by(Job.id)]
+
+    for i in range(0, len(ids), CHUNK):
+        for job in s.query(Job).filter(Job.id.in_(ids[i:i + CHUNK])):
+            job.update_runnable()
+        s.commit()
+        s.expunge_all()
+
+    count = s.query(RunnableJob).count()
+    print "Filled runnable_jobs with %d of %d candidate jobs" % (count, len(ids))
+
+
+def fill_leases(s):
+    """
+    Jobs assigned before leases existed have none, and would never be
+    reaped: they get a full lease from now, which their builder renews if
+    it is still running them.
+    """
+
+    count = s.query(Job).filter(
+        Job.assigned_at != None,
+        Job.finished_at == None,
+        Job.lease_expires_at == None,
+    ).update({Job.lease_expires_at: lease_expiry()},
+             synchronize_session=False)
+    s.commit()
+
+    if count:
+        print "Gave a lease to %d assigned jobs" % (count)
+
+
+def migrate(args, s):
+    # The schema changes are made outside of the session, which is only
+    # used for the data once they are done.
+    engine = s.bind
+    existing = set(inspect(engine).get_table_names())
+
+    # runnable_jobs only holds data derived from the jobs, an outdated one
+    # is recreated and filled rather than having its columns backfilled.
+    runnable = RunnableJob.__table__
+    if (runnable.name in existing and
+            _missing_columns(inspect(engine), runnable)):
+        runnable.drop(engine)
+        existing.remove(runnable.name)
+        print "Dropped outdated table '%s'" % (runnable.name)
+
+    created = create_tables(engine, existing)
+    add_columns(engine, existing)
+    create_indexes(engine)
+    fill_leases(s)
+
+    if args.runnable or runnable.name in created:
+        fill_runnable_jobs(s)
+
+
+def main(args, config):
+    with session() as s:
+        migrate(args, s)
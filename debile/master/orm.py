@@ -29,41 +29,64 @@ from firehose.model import Analysis
 from sqlalchemy.dialects.postgresql import INET
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import relationship, backref
-from sqlalchemy import (Table, Column, ForeignKey, UniqueConstraint,
-                        Integer, String, DateTime, Boolean)
+from sqlalchemy.orm import (Session, relationship, backref, object_session,
+                            joinedload, subqueryload)
+from sqlalchemy import (Table, Column, ForeignKey, UniqueConstraint, Index,
+                        Integer, Float, String, DateTime, Boolean, event, text)
 
 
-from debile.master.utils import config
+from debile.master.utils import config, repo_info
 from debile.master.arches import (get_preferred_affinity, get_source_arches)
 
 
 Base = declarative_base(metadata=metadata)
 
+# INET on PostgreSQL, plain strings elsewhere (e.g. sqlite)
+IPAddress = String(45).with_variant(INET(), "postgresql")
 
-def _debilize(self):
-    def getthing(obj, name):
-        if obj is None:
-            return None
-        if "." in name:
-            local, remote = name.split(".", 1)
-            foo = getattr(obj, local)
-            return getthing(foo, remote)
-        if name == "__str__":
-            return str(obj)
-        if name == "__debilize__":
-            return _debilize(obj)
-        if name == "__list__":
-            return [_debilize(x) for x in obj]
-        return getattr(obj, name)
 
+def _compile_path(path):
+    # A function reading a dotted _debile_objs path from an object, None if
+    # any hop is None. The last hop may be one of the special names below.
+    steps = path.split(".")
+    final = {
+        "__str__": str,
+        "__debilize__": _debilize,
+        "__list__": lambda objs: [_debilize(x) for x in objs],
+    }.get(steps[-1])
+    if final is not None:
+        steps = steps[:-1]
+
+    def get(obj):
+        for step in steps:
+            obj = getattr(obj, step)
+            if obj is None:
+                return None
+        return obj if final is None else final(obj)
+    return get
+
+
+def _row_version():
+    # Bumped by every UPDATE of the row, whichever process makes it, so that
+    # the response cache can tell whether what it holds is still current.
+    return Column(Integer, nullable=False, default=0,
+                  onupdate=text("row_version + 1"))
+
+
+_debilizers = {}
+
+
+def _debilize(self):
     if self is None:
         return None
 
-    ret = {}
-    for attribute, path in self._debile_objs.items():
-        ret[attribute] = getthing(self, path)
-    return ret
+    getters = _debilizers.get(type(self))
+    if getters is None:
+        getters = _debilizers[type(self)] = [
+            (attribute, _compile_path(path))
+            for attribute, path in self._debile_objs.items()
+        ]
+    return {attribute: get(self) for attribute, get in getters}
 
 
 class Person(Base):
@@ -86,7 +109,7 @@ class Person(Base):
     pgp = Column(String(40), nullable=True, default=None)
     ssl = Column(String(40), nullable=True, default=None)
 
-    ip = Column(INET, nullable=True, default=None)
+    ip = Column(IPAddress, nullable=True, default=None)
 
     def __str__(self):
         return "%s <%s>" % (self.name, self.email)
@@ -120,7 +143,11 @@ class Builder(Base):
     pgp = Column(String(40), nullable=True, default=None)
     ssl = Column(String(40), nullable=True, default=None)
 
-    ip = Column(INET, nullable=True, default=None)
+    ip = Column(IPAddress, nullable=True, default=None)
+
+    # How fast this builder runs jobs compared to the others (2 means twice
+    # as fast), learnt from its job_stats, see record_job_stat
+    speed = Column(Float, nullable=False, default=1.0)
 
     def __str__(self):
         return self.name
@@ -228,13 +255,26 @@ class Group(Base):
     debilize = _debilize
 
     id = Column(Integer, primary_key=True)
+    row_version = _row_version()
     name = Column(String(255), nullable=False)
 
     maintainer_id = Column(Integer, ForeignKey('people.id', ondelete="RESTRICT"), nullable=False)
     maintainer = relationship("Person", foreign_keys=[maintainer_id])
 
     def get_repo_info(self):
+        # Resolved once per group, until the repo config is reloaded or
+        # replaced.
         conf = config.get("repo", None)
+        key = (self.id, self.name)
+        cached = repo_info.get(key)
+        if cached is not None and cached[0] is conf:
+            return cached[1]
+
+        info = self._resolve_repo_info(conf)
+        repo_info[key] = (conf, info)
+        return info
+
+    def _resolve_repo_info(self, conf):
         custom_resolver = conf.get("custom_resolver", None)
         if custom_resolver:
             module, func = custom_resolver.rsplit(".", 1)
@@ -343,6 +383,8 @@ source_arch_association = (
 
 class Source(Base):
     __tablename__ = 'sources'
+    __table_args__ = (Index('ix_sources_group_suite_name_version',
+                            'group_suite_id', 'name', 'version'),)
     _debile_objs = {
         "id": "id",
         "name": "name",
@@ -367,6 +409,7 @@ class Source(Base):
         return obj
 
     id = Column(Integer, primary_key=True)
+    row_version = _row_version()
 
     name = Column(String(255), nullable=False)
     version = Column(String(255), nullable=False)
@@ -423,6 +466,7 @@ class Source(Base):
 
 class Maintainer(Base):
     __tablename__ = 'maintainers'
+    __table_args__ = (Index('ix_maintainers_source_id', 'source_id'),)
     _debile_objs = {
         "id": "id",
         "name": "name",
@@ -453,6 +497,8 @@ class Maintainer(Base):
 
 class Binary(Base):
     __tablename__ = 'binaries'
+    __table_args__ = (Index('ix_binaries_source_id', 'source_id'),
+                      Index('ix_binaries_build_job_id', 'build_job_id'))
     _debile_objs = {
         "id": "id",
         "name": "name",
@@ -475,6 +521,7 @@ class Binary(Base):
         return obj
 
     id = Column(Integer, primary_key=True)
+    row_version = _row_version()
 
     @hybrid_property
     def name(self):
@@ -498,21 +545,21 @@ class Binary(Base):
     build_job = relationship("Job", foreign_keys=[build_job_id],
                              backref=backref("built_binaries", order_by=id, passive_deletes=True))
 
-    @hybrid_property
-    def group_suite(self):
-        return self.source.group_suite
+    # Copies of those of the source, so that binaries can be filtered
+    # without joining it.
+    group_suite_id = Column(Integer, ForeignKey('group_suites.id', ondelete="RESTRICT"), nullable=False)
+    group_suite = relationship("GroupSuite", foreign_keys=[group_suite_id])
 
     @hybrid_property
     def group(self):
-        return self.source.group
+        return self.group_suite.group
 
     @hybrid_property
     def suite(self):
-        return self.source.suite
+        return self.group_suite.suite
 
-    @hybrid_property
-    def component(self):
-        return self.source.component
+    component_id = Column(Integer, ForeignKey('components.id', ondelete="RESTRICT"), nullable=False)
+    component = relationship("Component", foreign_keys=[component_id])
 
     uploaded_at = Column(DateTime, nullable=False)
 
@@ -525,6 +572,7 @@ class Binary(Base):
 
 class Deb(Base):
     __tablename__ = 'debs'
+    __table_args__ = (Index('ix_debs_binary_id', 'binary_id'),)
     _debile_objs = {
         "id": "id",
         "directory": "directory",
@@ -587,9 +635,26 @@ job_dependencies = (
           Column('blocked_job_id', Integer, ForeignKey('jobs.id', ondelete="CASCADE"), nullable=False),
           Column('blocking_job_id', Integer, ForeignKey('jobs.id', ondelete="CASCADE"), nullable=False)))
 
+Index('ix_job_dependencies_blocked', job_dependencies.c.blocked_job_id)
+Index('ix_job_dependencies_blocking', job_dependencies.c.blocking_job_id)
+
+
+_RUNNING = "assigned_at IS NOT NULL AND finished_at IS NULL"
+
 
 class Job(Base):
     __tablename__ = 'jobs'
+    __table_args__ = (Index('ix_jobs_source_id', 'source_id'),
+                      Index('ix_jobs_binary_id', 'binary_id'),
+                      Index('ix_jobs_check_id', 'check_id'),
+                      Index('ix_jobs_arch_id', 'arch_id'),
+                      Index('ix_jobs_builder_id', 'builder_id'),
+                      # The running jobs, see reap_expired_leases and the
+                      # fair-share policy. runnable_jobs is the index of the
+                      # unassigned ones.
+                      Index('ix_jobs_running', 'lease_expires_at',
+                            postgresql_where=text(_RUNNING),
+                            sqlite_where=text(_RUNNING)))
     _debile_objs = {
         "id": "id",
         "source": "source.__str__",
@@ -617,6 +682,7 @@ class Job(Base):
         return obj
 
     id = Column(Integer, primary_key=True)
+    row_version = _row_version()
 
     @hybrid_property
     def name(self):
@@ -629,21 +695,21 @@ class Job(Base):
     check_id = Column(Integer, ForeignKey('checks.id', ondelete="RESTRICT"), nullable=False)
     check = relationship("Check", foreign_keys=[check_id])
 
-    @hybrid_property
-    def group_suite(self):
-        return self.source.group_suite
+    # Copies of those of the source, so that jobs can be filtered without
+    # joining it.
+    group_suite_id = Column(Integer, ForeignKey('group_suites.id', ondelete="RESTRICT"), nullable=False)
+    group_suite = relationship("GroupSuite", foreign_keys=[group_suite_id])
 
     @hybrid_property
     def group(self):
-        return self.source.group
+        return self.group_suite.group
 
     @hybrid_property
     def suite(self):
-        return self.source.suite
+        return self.group_suite.suite
 
-    @hybrid_property
-    def component(self):
-        return self.source.component
+    component_id = Column(Integer, ForeignKey('components.id', ondelete="RESTRICT"), nullable=False)
+    component = relationship("Component", foreign_keys=[component_id])
 
     arch_id = Column(Integer, ForeignKey('arches.id', ondelete="RESTRICT"), nullable=False)
     arch = relationship("Arch", foreign_keys=[arch_id])
@@ -670,6 +736,13 @@ class Job(Base):
     finished_at = Column(DateTime, nullable=True, default=None)
     failed = Column(Boolean, nullable=True, default=None)
 
+    # Assigned jobs go back to the runnable set if the builder doesn't renew
+    # its lease before this, see DebileMasterInterface.renew_lease
+    lease_expires_at = Column(DateTime, nullable=True, default=None)
+
+    # Predicted run time on a builder of speed 1, see estimate_duration
+    estimated_duration = Column(Float, nullable=True, default=None)
+
     depedencies = relationship(
         "Job", secondary=job_dependencies, passive_deletes=True,
         cascade="save-update, merge, delete",
@@ -679,11 +752,62 @@ class Job(Base):
         secondaryjoin=(id == job_dependencies.c.blocked_job_id),
     )
 
+    # Whether the build job also builds the arch:all packages: it is the
+    # one on the source affinity, and the source has no arch:all binary
+    # yet. Set by create_jobs, cleared by new_binary.
+    do_indep = Column(Boolean, nullable=False, default=False)
+
     @property
-    def do_indep(self):
-        return (self.check.build and
-                self.arch == self.source.affinity and
-                not any(x.arch.name == "all" for x in self.source.binaries))
+    def run_arch(self):
+        # Arch "source" and "all" jobs are run on the source affinity.
+        if self.arch.name in ["source", "all"]:
+            return self.source.affinity
+        return self.arch
+
+    def estimate_duration(self):
+        # Avoid a circular import, the scheduler needs the models.
+        from debile.master.scheduler import estimate_cost
+
+        if self.estimated_duration is None:
+            self.estimated_duration = estimate_cost(object_session(self), self)
+        return self.estimated_duration
+
+    def critical_path(self):
+        # Time until the last of the jobs blocked by this one can be done.
+        return (self.estimate_duration() or 0) + max(
+            [x.critical_path() for x in self.blocking] or [0])
+
+    def is_runnable(self):
+        # The dependencies come last: they may need a query, the columns
+        # are already loaded.
+        return (self.dose_report is None and
+                self.assigned_at is None and
+                self.finished_at is None and
+                self.failed is None and
+                not self.depedencies)
+
+    # Called before every flush that touches the job, see _update_runnable_jobs
+    def update_runnable(self):
+        if not self.is_runnable():
+            self.runnable = None
+            return
+
+        # Avoid a circular import, the scheduler needs the models.
+        from debile.master.scheduler import get_policy
+
+        if self.runnable is None:
+            self.runnable = RunnableJob()
+            self.runnable.cost = self.estimate_duration()
+            self.runnable.critical_path = self.critical_path()
+
+        self.runnable.suite = self.group_suite.suite
+        self.runnable.component = self.component
+        self.runnable.arch = self.run_arch
+        self.runnable.check = self.check
+        self.runnable.group = self.group_suite.group
+        self.runnable.uploader = self.source.uploader
+        self.runnable.priority = get_policy().priority(self)
+        self.runnable.uploaded_at = self.source.uploaded_at
 
     # Called when the .changes for a build job is processed
     def new_binary(self, arch=None):
@@ -695,11 +819,14 @@ class Job(Base):
             raise ValueError("add_binary() called with invalid arch!")
 
         binary = Binary(build_job=self, source=self.source, arch=arch,
+                        group_suite=self.group_suite, component=self.component,
                         uploaded_at=datetime.utcnow())
 
         for job in self.source.jobs:
             if (job.check.binary and job.source == self.source and job.arch == arch):
                 job.binary = binary
+            if arch.name == "all":
+                job.do_indep = False
 
         self.dose_report = None
         for job in list(self.blocking):
@@ -727,8 +854,108 @@ class Job(Base):
         return "<Job: %s %s (%s)>" % (self.source, self.name, self.id)
 
 
+class RunnableJob(Base):
+    """
+    Jobs that can be handed out to a builder right now, denormalized so that
+    `get_next_job` is a single index range scan, whatever the number of jobs
+    in the database. Rows are kept current by `_update_runnable_jobs`.
+    """
+
+    __tablename__ = 'runnable_jobs'
+    __table_args__ = (Index('ix_runnable_jobs_dispatch',
+                            'suite_id', 'component_id', 'arch_id', 'check_id',
+                            'priority', 'uploaded_at'),
+                      Index('ix_runnable_jobs_priority', 'priority', 'uploaded_at'))
+
+    job_id = Column(Integer, ForeignKey('jobs.id', ondelete="CASCADE"), primary_key=True)
+    job = relationship("Job", foreign_keys=[job_id],
+                       backref=backref("runnable", uselist=False, passive_deletes=True,
+                                       cascade="save-update, merge, delete, delete-orphan"))
+
+    suite_id = Column(Integer, ForeignKey('suites.id', ondelete="RESTRICT"), nullable=False)
+    suite = relationship("Suite", foreign_keys=[suite_id])
+
+    component_id = Column(Integer, ForeignKey('components.id', ondelete="RESTRICT"), nullable=False)
+    component = relationship("Component", foreign_keys=[component_id])
+
+    # The arch the job will run on, i.e. the source affinity for arch
+    # "source" and "all" jobs.
+    arch_id = Column(Integer, ForeignKey('arches.id', ondelete="RESTRICT"), nullable=False)
+    arch = relationship("Arch", foreign_keys=[arch_id])
+
+    check_id = Column(Integer, ForeignKey('checks.id', ondelete="RESTRICT"), nullable=False)
+    check = relationship("Check", foreign_keys=[check_id])
+
+    # Used by the fair-share scheduling policy
+    group_id = Column(Integer, ForeignKey('groups.id', ondelete="RESTRICT"), nullable=False)
+    group = relationship("Group", foreign_keys=[group_id])
+
+    uploader_id = Column(Integer, ForeignKey('people.id', ondelete="RESTRICT"), nullable=False)
+    uploader = relationship("Person", foreign_keys=[uploader_id])
+
+    # Lower goes first, computed by the configured SchedulingPolicy
+    priority = Column(Float, nullable=False)
+    uploaded_at = Column(DateTime, nullable=False)
+
+    # Expected run time on a builder of speed 1, if there is some history
+    # for the source, and the same including the jobs it blocks; see
+    # Job.estimate_duration
+    cost = Column(Float, nullable=True, default=None)
+    critical_path = Column(Float, nullable=True, default=None)
+
+    def __repr__(self):
+        return "<RunnableJob: %s>" % (self.job_id)
+
+
+@event.listens_for(Session, 'before_flush')
+def _update_runnable_jobs(session, flush_context, instances):
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Job) and obj not in session.deleted:
+            obj.update_runnable()
+
+
+class JobStat(Base):
+    """
+    How long a job took on its builder, kept after the job itself is gone
+    so that the next versions of the source can be scheduled with it.
+    """
+
+    __tablename__ = 'job_stats'
+    __table_args__ = (UniqueConstraint('job_id'),
+                      Index('ix_job_stats_history', 'source_name', 'check_id', 'arch_id'))
+
+    id = Column(Integer, primary_key=True)
+
+    job_id = Column(Integer, ForeignKey('jobs.id', ondelete="SET NULL"), nullable=True)
+    job = relationship("Job", foreign_keys=[job_id])
+
+    builder_id = Column(Integer, ForeignKey('builders.id', ondelete="CASCADE"), nullable=False)
+    builder = relationship("Builder", foreign_keys=[builder_id])
+
+    arch_id = Column(Integer, ForeignKey('arches.id', ondelete="RESTRICT"), nullable=False)
+    arch = relationship("Arch", foreign_keys=[arch_id])
+
+    check_id = Column(Integer, ForeignKey('checks.id', ondelete="RESTRICT"), nullable=False)
+    check = relationship("Check", foreign_keys=[check_id])
+
+    source_name = Column(String(255), nullable=False)
+    finished_at = Column(DateTime, nullable=False)
+
+    # Seconds between assignment and completion, and the same scaled by the
+    # builder speed at the time, comparable across builders
+    wall_time = Column(Float, nullable=False)
+    normalized_time = Column(Float, nullable=False)
+
+    # Seconds spent building, as reported by sbuild in the firehose stats
+    build_time = Column(Float, nullable=True, default=None)
+
+    def __repr__(self):
+        return "<JobStat: %s %s (%s)>" % (self.source_name, self.check_id, self.id)
+
+
 class Result(Base):
     __tablename__ = 'results'
+    __table_args__ = (Index('ix_results_job_id', 'job_id'),)
     _debile_objs = {
         "id": "id",
         "job": "job.__str__",
@@ -821,6 +1048,69 @@ class Result(Base):
         )
 
 
+def _debilize_loads():
+    # The relationships read by the debilize() of each class, as paths
+    # from it. Relationships to objects which are loaded by then anyway
+    # (e.g. the source of the binary of a job) are left out, their lazy
+    # loads are served from the identity map. Built on first use, once the
+    # backrefs exist.
+    source = [
+        (Source.group_suite, GroupSuite.group, Group.maintainer),
+        (Source.group_suite, GroupSuite.suite),
+        (Source.component,),
+        (Source.affinity,),
+        (Source.uploader,),
+        (Source.maintainers,),
+    ]
+    binary = [
+        (Binary.arch,),
+        (Binary.debs,),
+        (Binary.build_job, Job.builder, Builder.maintainer),
+    ]
+    job = [
+        (Job.check,),
+        (Job.arch,),
+        (Job.builder, Builder.maintainer),
+    ] + [(Job.source,) + x for x in source] + [
+        (Job.binary,) + x for x in binary]
+
+    return {
+        Group: [(Group.maintainer,)],
+        Builder: [(Builder.maintainer,)],
+        Source: source,
+        Binary: binary + [(Binary.source,) + x for x in source],
+        Job: job,
+        Result: [(Result.job,) + x for x in job],
+    }
+
+
+_debilize_paths = {}
+
+
+def debilize_options(cls, prefix=None):
+    """
+    Loader options fetching everything the debilize() of `cls` reads, so
+    that it runs in a few queries rather than one per relationship: joins
+    for single objects, and one more query per collection. Pass a loader
+    option as `prefix` to load them below another relationship.
+    """
+
+    if not _debilize_paths:
+        _debilize_paths.update(_debilize_loads())
+
+    options = []
+    for path in _debilize_paths.get(cls, []):
+        option = prefix
+        for attribute in path:
+            loader = subqueryload if attribute.property.uselist else joinedload
+            if option is None:
+                option = loader(attribute)
+            else:
+                option = getattr(option, loader.__name__)(attribute)
+        options.append(option)
+    return options
+
+
 def create_source(dsc, group_suite, component, uploader,
                   affinity_preference, valid_affinities):
     source = Source(
@@ -894,9 +1184,12 @@ def create_jobs(source, dose_report=None):
     for binary in source.binaries:
         binaries[binary.arch] = binary
 
+    do_indep = arch_all not in binaries
+
     for check in source.group_suite.get_source_checks():
         j = Job(check=check, arch=arch_source,
-                source=source, binary=None)
+                source=source, binary=None,
+                group_suite=source.group_suite, component=source.component)
         source.jobs.append(j)
 
     arch_indep = None
@@ -917,6 +1210,8 @@ def create_jobs(source, dose_report=None):
             if arch not in binaries:
                 j = Job(check=check, arch=arch,
                         source=source, binary=None,
+                        group_suite=source.group_suite, component=source.component,
+                        do_indep=do_indep and arch == source.affinity,
                         dose_report=dose_report)
                 builds[arch] = j
                 source.jobs.append(j)
@@ -932,13 +1227,9 @@ def create_jobs(source, dose_report=None):
             binary = binaries.get(arch, None)
 
             j = Job(check=check, arch=arch,
-                    source=source, binary=binary)
+                    source=source, binary=binary,
+                    group_suite=source.group_suite, component=source.component)
             source.jobs.append(j)
 
             for dep in deps:
                 j.depedencies.append(dep)
-
-    for job in source.jobs:
-        # Fake the assigned_count to prioritize build jobs an production suites slightly.
-        job.assigned_count = ((4 if job.source.suite.name in ["staging", "sid", "experimental"] else 0) +
-                              (8 if not job.check.build else 0))
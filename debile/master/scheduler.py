@@ -0,0 +1,599 @@
+# Copyright (c) 2026      agent <agent@local>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from debile.master.utils import config
+from debile.master.workers import WORKERS
+from debile.master.orm import Job, RunnableJob, JobStat, Source, GroupSuite
+from debile.master.cache import names
+
+from copy import deepcopy
+from datetime import datetime, timedelta
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session, joinedload
+
+import threading
+import time
+
+
+# How many times a builder races for a job before giving up on this poll.
+CLAIM_RETRIES = 10
+
+# Default upper bound on the number of jobs claimed by a get_next_jobs call.
+MAX_JOBS_PER_POLL = 16
+
+# Default number of seconds a builder may go without renewing its lease.
+LEASE_DURATION = 300
+
+# Default upper bound on how long a poll may wait for a job, and how often
+# runnable_jobs is checked for jobs made runnable by other processes (e.g.
+# debile-incoming), which can't wake waiting polls up.
+MAX_POLL_WAIT = 50
+POLL_RECHECK = 5
+
+
+# Penalties used by the weighted policies when master.yaml doesn't set any;
+# they keep staging/sid/experimental and non-build jobs behind the others.
+DEFAULT_PENALTIES = {
+    'suites': {'staging': 4, 'sid': 4, 'experimental': 4},
+    'groups': {},
+    'checks': {},
+    'non_build': 8,
+}
+
+# Default number of seconds of waiting that makes up for one unit of
+# penalty under the aging policy.
+AGING_INTERVAL = 3600
+
+_EPOCH = datetime(1970, 1, 1)
+
+# Builders at least this much faster (or slower) than average are handed
+# the most (or least) expensive jobs first, see SchedulingPolicy.placement
+FAST_BUILDER = 1.25
+SLOW_BUILDER = 0.8
+
+# Weight of the last job in a builder's speed, and bounds on what a single
+# job may say about it.
+SPEED_SMOOTHING = 0.2
+SPEED_RANGE = (0.1, 10.0)
+
+
+class SchedulingPolicy(object):
+    """
+    Decides in which order runnable jobs are handed out.
+
+    `priority` is computed once per job, whenever its runnable_jobs entry is
+    written, and stored in RunnableJob.priority (lower goes first); `order`
+    turns it into an ORDER BY, possibly against the current state of the
+    queue, so that the database picks the next jobs.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.penalties = dict(DEFAULT_PENALTIES,
+                              **settings.get('penalties', {}))
+        self.quotas = settings.get('quotas', {})
+
+    def penalty(self, job):
+        suite = job.source.group_suite.suite.name
+        group = job.source.group_suite.group.name
+        return (self.penalties['suites'].get(suite, 0) +
+                self.penalties['groups'].get(group, 0) +
+                self.penalties['checks'].get(job.check.name, 0) +
+                (self.penalties['non_build'] if not job.check.build else 0))
+
+    def priority(self, job):
+        # None until the job is inserted, see the column default
+        return job.assigned_count or 0
+
+    def placement(self, builder):
+        """
+        Ordering between jobs of equal priority, based on how fast `builder`
+        is: fast builders take the expensive jobs, which would make the
+        rebuild drag on if they landed on a slow one, and slow builders the
+        cheap ones. Jobs without history count as cheap.
+        """
+
+        speed_aware = self.settings.get('speed_aware', {})
+        if builder is None or speed_aware is False:
+            return []
+
+        cost = func.coalesce(RunnableJob.cost, 0)
+        if builder.speed >= speed_aware.get('fast', FAST_BUILDER):
+            return [cost.desc()]
+        if builder.speed <= speed_aware.get('slow', SLOW_BUILDER):
+            return [cost.asc()]
+        return []
+
+    def order(self, session, query, builder=None):
+        return query.order_by(
+            RunnableJob.priority.asc(),
+            *(self.placement(builder) + [RunnableJob.uploaded_at.asc()])
+        )
+
+    def apply(self, session, query, builder=None):
+        if self.quotas:
+            # Groups which already have their quota of jobs running get
+            # nothing more until some of them complete.
+            quotas = {}
+            for name, quota in self.quotas.items():
+                for id in names.group_ids(session, [name]):
+                    quotas[id] = quota
+            full = [id for id, running in _running_jobs(session, 'group')
+                    if id in quotas and running >= quotas[id]]
+            if full:
+                query = query.filter(~RunnableJob.group_id.in_(full))
+        return self.order(session, query, builder)
+
+
+class FifoPolicy(SchedulingPolicy):
+    """
+    Oldest uploads first, jobs which were forfeited go to the back.
+    """
+
+
+class WeightedPolicy(SchedulingPolicy):
+    """
+    Like fifo, but suites, groups and checks can be given penalties.
+    """
+
+    def priority(self, job):
+        return SchedulingPolicy.priority(self, job) + self.penalty(job)
+
+
+class AgingPolicy(SchedulingPolicy):
+    """
+    Weighted priorities which fade as jobs wait, so that penalized jobs
+    still run eventually: each unit of penalty is worth `aging_interval`
+    seconds of waiting.
+
+    The priority is the upload time (in intervals) plus the penalty; since
+    time passes equally for every queued job, the order it gives does not
+    need to be recomputed as they age.
+    """
+
+    def priority(self, job):
+        interval = self.settings.get('aging_interval', AGING_INTERVAL)
+        age = job.source.uploaded_at - _EPOCH
+        return (age.days * 86400 + age.seconds) / float(interval) + (
+            SchedulingPolicy.priority(self, job) + self.penalty(job))
+
+
+class LongestFirstPolicy(WeightedPolicy):
+    """
+    Weighted priorities, then the jobs expected to take longest first, so
+    that a rebuild doesn't end on a few huge builds started late. Slow
+    builders still pick the cheap jobs.
+    """
+
+    # The RunnableJob column, by name: mapped attributes can't be class
+    # attributes of the policy, they would be read from its instances.
+    column = 'cost'
+
+    def placement(self, builder):
+        placement = super(LongestFirstPolicy, self).placement(builder)
+        if placement and builder.speed < 1:
+            return placement
+        return [func.coalesce(getattr(RunnableJob, self.column), 0).desc()]
+
+
+class CriticalPathPolicy(LongestFirstPolicy):
+    """
+    Like longest-first, but counting the run time of the jobs each job
+    blocks (e.g. the binary checks waiting for a build).
+    """
+
+    column = 'critical_path'
+
+
+class FairSharePolicy(WeightedPolicy):
+    """
+    Weighted priorities, but the groups (or uploaders) with the fewest jobs
+    currently running go first, so that a mass rebuild in one group doesn't
+    starve the others.
+    """
+
+    def order(self, session, query, builder=None):
+        share = self.settings.get('fair_share', 'group')
+        column = {
+            'group': RunnableJob.group_id,
+            'uploader': RunnableJob.uploader_id,
+        }[share]
+
+        running = _running_jobs_query(session, share).subquery()
+        return query.outerjoin(
+            running, running.c.id == column,
+        ).order_by(
+            func.coalesce(running.c.running, 0).asc(),
+            RunnableJob.priority.asc(),
+            *(self.placement(builder) + [RunnableJob.uploaded_at.asc()])
+        )
+
+
+POLICIES = {
+    'fifo': FifoPolicy,
+    'weighted': WeightedPolicy,
+    'aging': AgingPolicy,
+    'longest-first': LongestFirstPolicy,
+    'critical-path': CriticalPathPolicy,
+    'fair-share': FairSharePolicy,
+}
+
+_policy = (None, None)
+_policy_lock = threading.Lock()
+
+
+def get_policy():
+    """
+    Return the SchedulingPolicy configured in the `scheduler' section of
+    master.yaml (weighted by default).
+    """
+
+    global _policy
+    settings = config.get('scheduler') or {}
+    with _policy_lock:
+        if _policy[0] != settings:
+            name = settings.get('policy', 'weighted')
+            if name not in POLICIES:
+                raise ValueError("Unknown scheduling policy: %s" % (name))
+            _policy = (deepcopy(settings), POLICIES[name](settings))
+        return _policy[1]
+
+
+def _running_jobs_query(session, share):
+    column, join = {
+        'group': (GroupSuite.group_id, Job.group_suite),
+        'uploader': (Source.uploader_id, Job.source),
+    }[share]
+    return session.query(
+        column.label('id'), func.count(Job.id).label('running'),
+    ).select_from(Job).join(join).filter(
+        Job.assigned_at != None,
+        Job.finished_at == None,
+    ).group_by(column)
+
+
+def _running_jobs(session, share):
+    return _running_jobs_query(session, share).all()
+
+
+def estimate_cost(session, job):
+    """
+    Expected run time of `job` on a builder of speed 1, from the previous
+    runs of the same check on the source (preferably on the same arch),
+    or None if it never ran.
+    """
+
+    history = session.query(func.avg(JobStat.normalized_time)).filter(
+        JobStat.source_name == job.source.name,
+        JobStat.check_id == job.check.id,
+    )
+
+    cost = history.filter(JobStat.arch_id == job.run_arch.id).scalar()
+    if cost is None:
+        cost = history.scalar()
+    return cost
+
+
+def record_job_stat(session, job, build_time=None):
+    """
+    Record how long `job` took on its builder once it is closed, and adjust
+    the builder speed accordingly. `build_time` is the time reported in the
+    job's firehose stats, which may come in before or after the job is
+    closed.
+    """
+
+    stat = session.query(JobStat).filter_by(job_id=job.id).first()
+    if stat is None:
+        if job.builder is None or job.assigned_at is None or job.finished_at is None:
+            # Not closed yet, the build time will be picked up from the
+            # job's results then.
+            return None
+
+        wall_time = max((job.finished_at - job.assigned_at).total_seconds(), 1.0)
+        reference = estimate_cost(session, job)
+
+        builder = job.builder
+        if reference is not None:
+            ratio = min(max(reference / wall_time, SPEED_RANGE[0]), SPEED_RANGE[1])
+            builder.speed = ((1 - SPEED_SMOOTHING) * builder.speed +
+                             SPEED_SMOOTHING * ratio)
+
+        stat = JobStat(job=job, builder=builder, arch=job.run_arch,
+                       check=job.check, source_name=job.source.name,
+                       finished_at=job.finished_at, wall_time=wall_time,
+                       normalized_time=wall_time * builder.speed)
+        session.add(stat)
+
+        for result in job.results:
+            if result.firehose is not None and result.firehose.metadata.stats:
+                build_time = result.firehose.metadata.stats.wallclocktime
+
+    if build_time is not None:
+        stat.build_time = build_time
+    return stat
+
+
+def jobs_per_poll(count):
+    """
+    Check the number of jobs a builder asks for, at most max_jobs_per_poll
+    are handed out.
+    """
+
+    if isinstance(count, bool) or not isinstance(count, (int, long)) or count < 1:
+        raise ValueError("Invalid number of jobs: %r" % (count,))
+    return min(count, config.get('max_jobs_per_poll', MAX_JOBS_PER_POLL))
+
+
+def poll_wait(wait):
+    """
+    Check the number of seconds a builder is willing to wait for a job, at
+    most max_wait are actually waited, see wait_for_jobs.
+    """
+
+    if (isinstance(wait, bool) or not isinstance(wait, (int, long, float)) or
+            not wait >= 0):
+        raise ValueError("Invalid wait: %r" % (wait,))
+    return wait
+
+
+def lease_expiry():
+    duration = config.get('leases', {}).get('duration', LEASE_DURATION)
+    return datetime.utcnow() + timedelta(seconds=duration)
+
+
+def runnable_jobs(session, suites, components, arches, checks, builder=None):
+    """
+    Query the jobs that builders with the given capabilities can run,
+    in dispatch order (for `builder`, if given).
+    """
+
+    arches = [x for x in arches if x not in ["source", "all"]]
+    query = session.query(RunnableJob).filter(
+        RunnableJob.suite_id.in_(names.suite_ids(session, suites)),
+        RunnableJob.component_id.in_(names.component_ids(session, components)),
+        RunnableJob.arch_id.in_(names.arch_ids(session, arches)),
+        RunnableJob.check_id.in_(names.check_ids(session, checks)),
+    )
+    return get_policy().apply(session, query, builder)
+
+
+def claim_jobs(session, builder, suites, components, arches, checks, count):
+    """
+    Assign up to `count` runnable jobs to `builder`, making sure no other
+    builder polling at the same time can be handed the same jobs. Returns
+    the claimed jobs in dispatch order.
+    """
+
+    query = runnable_jobs(session, suites, components, arches, checks, builder)
+    if session.get_bind().dialect.name == "postgresql":
+        return _claim_locked(session, builder, query, count)
+    return _claim_conditional(session, builder, query, count)
+
+
+def claim_job(session, builder, suites, components, arches, checks):
+    """
+    Assign the next runnable job to `builder`, or return None if there is
+    nothing to do.
+    """
+
+    jobs = claim_jobs(session, builder, suites, components, arches, checks, 1)
+    return jobs[0] if jobs else None
+
+
+def _claim_locked(session, builder, query, count):
+    # Rows locked by concurrent pollers are skipped rather than waited for,
+    # the locks are held until the request's transaction is committed.
+    entries = query.options(
+        joinedload(RunnableJob.job, innerjoin=True),
+    ).with_for_update(of=RunnableJob, skip_locked=True).limit(count).all()
+
+    jobs = [x.job for x in entries]
+    for job in jobs:
+        job.assigned_count += 1
+        job.assigned_at = datetime.utcnow()
+        job.lease_expires_at = lease_expiry()
+        job.builder = builder
+    return jobs
+
+
+def _claim_conditional(session, builder, query, count):
+    # No SKIP LOCKED here (sqlite), so only the poller whose UPDATE still
+    # finds a job unassigned wins it; the others retry with the next ones.
+    claimed = []
+    for attempt in range(CLAIM_RETRIES):
+        candidates = query.with_entities(RunnableJob.job_id).limit(
+            count - len(claimed)).all()
+        if not candidates:
+            break
+
+        for job_id, in candidates:
+            won = session.query(Job).filter(
+                Job.id == job_id,
+                Job.assigned_at == None,
+            ).update({
+                Job.assigned_count: Job.assigned_count + 1,
+                Job.assigned_at: datetime.utcnow(),
+                Job.lease_expires_at: lease_expiry(),
+                Job.builder_id: builder.id,
+            }, synchronize_session=False)
+
+            # The bulk UPDATE bypasses the flush hooks maintaining
+            # runnable_jobs.
+            session.query(RunnableJob).filter(
+                RunnableJob.job_id == job_id,
+            ).delete(synchronize_session=False)
+
+            if won:
+                claimed.append(job_id)
+
+        if len(claimed) >= count:
+            break
+
+    if not claimed:
+        return []
+
+    jobs = session.query(Job).populate_existing().filter(Job.id.in_(claimed))
+    jobs = {x.id: x for x in jobs}
+    return [jobs[x] for x in claimed]
+
+
+def reap_expired_leases(session):
+    """
+    Put assigned jobs whose builder stopped renewing their lease back into
+    the runnable set. Returns the reaped jobs.
+    """
+
+    jobs = session.query(Job).filter(
+        Job.assigned_at != None,
+        Job.finished_at == None,
+        Job.lease_expires_at < datetime.utcnow(),
+    ).with_for_update(skip_locked=True).all()
+
+    for job in jobs:
+        job.assigned_at = None
+        job.lease_expires_at = None
+        job.builder = None
+    return jobs
+
+
+class RunnableWatch(object):
+    """
+    Where polls wait for jobs to become runnable. Jobs queued in this
+    process wake them up right away (see _notify_runnable_jobs). For those
+    queued by other processes, one of the waiting polls checks whether
+    runnable_jobs changed every `recheck' seconds on behalf of all of them,
+    so that idle builders cost one query per interval, not one each.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.waiting = 0
+        self.generation = 0
+        self.checked_at = 0
+        self.signature = None
+
+    def enter(self, limit):
+        """
+        Count a waiting poll in, unless `limit' of them are waiting
+        already.
+        """
+
+        with self.condition:
+            if self.waiting >= limit:
+                return False
+            self.waiting += 1
+            return True
+
+    def leave(self):
+        with self.condition:
+            self.waiting -= 1
+
+    def notify(self):
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+
+    def wait(self, session, timeout, recheck):
+        """
+        Wait up to `timeout' seconds, returns True if jobs may have become
+        runnable meanwhile.
+        """
+
+        with self.condition:
+            generation = self.generation
+            due = self.checked_at + recheck - time.time()
+            if due > 0:
+                self.condition.wait(min(timeout, due))
+                return self.generation != generation
+            self.checked_at = time.time()
+
+        signature = session.query(func.count(RunnableJob.job_id),
+                                  func.sum(RunnableJob.job_id)).one()
+
+        with self.condition:
+            changed = self.signature is not None and signature != self.signature
+            self.signature = signature
+            if changed:
+                self.generation += 1
+                self.condition.notify_all()
+            return changed or self.generation != generation
+
+
+_watch = RunnableWatch()
+
+
+def wait_for_jobs(session, builder, suites, components, arches, checks,
+                  count, wait):
+    """
+    Like claim_jobs, but if there is nothing to do, wait up to `wait`
+    seconds for matching jobs to become runnable.
+
+    Waiting polls hold a worker thread, so that at most `max_waiters' (half
+    of the workers by default) wait at once and the other workers remain
+    available for the other calls; the polls beyond that return right away.
+
+    Waiting commits the session, so polls made in a savepoint (i.e. in a
+    system.multicall, see SavepointMulticallMixIn) don't wait: committing
+    there would release the savepoint, then commit the calls made before
+    in the batch.
+    """
+
+    long_poll = config.get('long_poll', {})
+    deadline = time.time() + min(wait, long_poll.get('max_wait', MAX_POLL_WAIT))
+    recheck = long_poll.get('recheck', POLL_RECHECK)
+    workers = config.get('xmlrpc', {}).get('workers', WORKERS)
+    max_waiters = long_poll.get('max_waiters', max(workers // 2, 1))
+
+    jobs = claim_jobs(session, builder, suites, components, arches, checks, count)
+    if (jobs or deadline <= time.time() or session.transaction.nested or
+            not _watch.enter(max_waiters)):
+        return jobs
+
+    try:
+        while not jobs:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            # Don't sit in a transaction while waiting.
+            session.commit()
+            if _watch.wait(session, remaining, recheck):
+                jobs = claim_jobs(session, builder, suites, components,
+                                  arches, checks, count)
+    finally:
+        _watch.leave()
+    return jobs
+
+
+@event.listens_for(Session, 'after_flush')
+def _note_runnable_jobs(session, flush_context):
+    if any(isinstance(x, RunnableJob) for x in session.new):
+        session.info['runnable_jobs'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify_runnable_jobs(session):
+    if session.info.pop('runnable_jobs', False):
+        _watch.notify()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_runnable_jobs(session):
+    session.info.pop('runnable_jobs', None)
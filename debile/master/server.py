@@ -24,21 +24,91 @@
 
 from SimpleXMLRPCServer import SimpleXMLRPCServer
 from SimpleXMLRPCServer import SimpleXMLRPCRequestHandler
+from SimpleXMLRPCServer import SimpleXMLRPCDispatcher
 from sqlalchemy.sql import exists
 
 from debile.utils.xmlrpc import get_auth_method
 from debile.utils.log import start_logging
-from debile.master.utils import session
-from debile.master.orm import Person, Builder, Job
+from debile.master.utils import session, emit
+from debile.master.orm import Job
 from debile.master.interface import NAMESPACE, DebileMasterInterface
-
-import SocketServer
+from debile.master.scheduler import reap_expired_leases
+from debile.master.cache import names, identities
+from debile.master.workers import WorkerPool, WORKERS, BACKLOG
+from debile.master.metrics import MetricsServer
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from datetime import datetime
+
+import xmlrpclib
+import json
+import threading
+import socket
 import signal
+import time
 import hashlib
 import logging
 import logging.handlers
 import os.path
+import select
+import errno
 import ssl
+import sys
+
+
+# Seconds clients are told to wait before retrying when all the workers and
+# the backlog are busy.
+RETRY_AFTER = 5
+
+# Seconds a client may take to send its request or read the response
+# before its worker gives up on it.
+REQUEST_TIMEOUT = 60
+
+# Seconds a kept-alive connection may stay idle before it is closed. Longer
+# than the builders' lease renewal interval, so that they keep their
+# connection (and don't do a new TLS handshake) while they work on a job.
+KEEP_ALIVE = 90
+
+# Most connections kept alive at once, the others are closed after their
+# request.
+MAX_IDLE = 1024
+
+# Seconds a client which is turned down may take to do its TLS handshake.
+HANDSHAKE_TIMEOUT = 5
+
+
+# The DebileMasterInterface is served as JSON-RPC 2.0 on this path, and as
+# XML-RPC on the others.
+JSON_PATH = "/json"
+
+
+def content_type(path):
+    return "application/json" if path == JSON_PATH else "text/xml"
+
+
+def http_response(code, body="", headers=(), keep_alive=True, path=None):
+    lines = ["HTTP/1.1 %d %s" % (code, BaseHTTPRequestHandler.responses[code][0])]
+    if code == 200:
+        lines.append("Content-Type: %s" % (content_type(path)))
+    lines.extend("%s: %s" % x for x in headers)
+    lines.append("Content-Length: %d" % (len(body)))
+    if not keep_alive:
+        lines.append("Connection: close")
+    return "\r\n".join(lines) + "\r\n\r\n" + body
+
+
+def make_ssl_context(keyfile, certfile, ca_certs):
+    """
+    Server-side TLS settings, shared by every connection so that clients
+    can resume their sessions instead of doing a full handshake.
+    """
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+    context.load_cert_chain(certfile, keyfile)
+    if ca_certs is not None:
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_verify_locations(ca_certs)
+    return context
 
 
 def check_shutdown():
@@ -50,19 +120,81 @@ def check_shutdown():
             raise SystemExit(0)
 
 
-class DebileMasterAuthMixIn(SimpleXMLRPCRequestHandler):
-    def authenticate(self):
-        cert = self.connection.getpeercert(True)
-        fingerprint = hashlib.sha1(cert).hexdigest().upper()
+class LeaseReaper(threading.Thread):
+    """
+    Returns jobs whose builder died (or lost contact) mid-job to the runnable
+    set once their lease expires.
+    """
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self, name="lease-reaper")
+        self.daemon = True
+        self.interval = interval
+
+    def run(self):
+        logger = logging.getLogger('debile')
+        while True:
+            time.sleep(self.interval)
+            try:
+                with session() as s:
+                    for job in reap_expired_leases(s):
+                        logger.info("Lease expired for job %s, rescheduling it", job.id)
+                        emit('abort', 'job', job.debilize())
+            except Exception:
+                logger.warning("Error while reaping expired leases", exc_info=True)
+
+
+def authenticate(fingerprint=None, address=None):
+    """
+    Look up the builder or user with the given SSL certificate fingerprint
+    (or, with simple authentication, IP address) and store them in NAMESPACE.
+    """
+
+    if fingerprint is not None:
+        criteria = {'ssl': fingerprint}
+    else:
+        criteria = {'ip': address}
+
+    NAMESPACE.machine, NAMESPACE.user = identities.lookup(
+        NAMESPACE.session, **criteria)
+
+    return NAMESPACE.machine or NAMESPACE.user
+
+
+def cert_fingerprint(connection):
+    cert = connection.getpeercert(True)
+    return hashlib.sha1(cert).hexdigest().upper()
+
+
+class DebileRequestHandler(SimpleXMLRPCRequestHandler):
+    rpc_paths = SimpleXMLRPCRequestHandler.rpc_paths + (JSON_PATH,)
 
-        NAMESPACE.machine = NAMESPACE.session.query(Builder).filter_by(
-            ssl=fingerprint
-        ).first()
-        NAMESPACE.user = NAMESPACE.session.query(Person).filter_by(
-            ssl=fingerprint
-        ).first()
+    # Clients keep their connection (and TLS session) for the next calls.
+    protocol_version = "HTTP/1.1"
 
-        return NAMESPACE.machine or NAMESPACE.user
+    def handle(self):
+        # Requests already read along with this one are served right away,
+        # otherwise the server watches the connection for the next one, see
+        # IdleConnections.
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection and self.request_pending():
+            self.handle_one_request()
+
+    def request_pending(self):
+        if isinstance(self.connection, ssl.SSLSocket) and self.connection.pending():
+            return True
+        return bool(self.rfile._rbuf.getvalue())
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == "content-type":
+            value = content_type(self.path)
+        SimpleXMLRPCRequestHandler.send_header(self, keyword, value)
+
+
+class DebileMasterAuthMixIn(DebileRequestHandler):
+    def authenticate(self):
+        return authenticate(fingerprint=cert_fingerprint(self.connection))
 
     def parse_request(self, *args):
         if SimpleXMLRPCRequestHandler.parse_request(self, *args):
@@ -86,18 +218,10 @@ class DebileMasterAuthMixIn(SimpleXMLRPCRequestHandler):
             check_shutdown()
 
 
-class DebileMasterSimpleAuthMixIn(SimpleXMLRPCRequestHandler):
+class DebileMasterSimpleAuthMixIn(DebileRequestHandler):
     def authenticate(self):
         client_address, _ = self.client_address
-        NAMESPACE.machine = NAMESPACE.session.query(Builder).filter_by(
-            ip=client_address
-        ).first()
-
-        NAMESPACE.user = NAMESPACE.session.query(Person).filter_by(
-            ip=client_address
-        ).first()
-
-        return NAMESPACE.machine or NAMESPACE.user
+        return authenticate(address=client_address)
 
     def parse_request(self, *args):
         if SimpleXMLRPCRequestHandler.parse_request(self, *args):
@@ -121,32 +245,278 @@ class DebileMasterSimpleAuthMixIn(SimpleXMLRPCRequestHandler):
             check_shutdown()
 
 
-class SimpleAsyncXMLRPCServer(SocketServer.ThreadingMixIn,
-                              DebileMasterSimpleAuthMixIn):
-    pass
+class SimpleAsyncXMLRPCServer(DebileMasterSimpleAuthMixIn):
+    timeout = REQUEST_TIMEOUT
 
 
-class AsyncXMLRPCServer(SocketServer.ThreadingMixIn, DebileMasterAuthMixIn):
-    pass
+class AsyncXMLRPCServer(DebileMasterAuthMixIn):
+    timeout = REQUEST_TIMEOUT
 
 
-class SimpleAuthXMLRPCServer(SimpleXMLRPCServer):
+class SavepointMulticallMixIn(object):
+    """
+    system.multicall, with all the calls of a batch run in the request
+    session, so in one transaction, but each in its own savepoint, so that
+    a failing call doesn't take the others down with it. Long polls don't
+    wait in a batch, see wait_for_jobs.
+    """
+
+    def system_multicall(self, call_list):
+        session = NAMESPACE.session
+
+        results = []
+        for call in call_list:
+            savepoint = session.begin_nested()
+            try:
+                result = self._dispatch(call['methodName'], call['params'])
+            except:
+                savepoint.rollback()
+                exc_type, exc_value, _ = sys.exc_info()
+                if isinstance(exc_value, xmlrpclib.Fault):
+                    results.append({'faultCode': exc_value.faultCode,
+                                    'faultString': exc_value.faultString})
+                else:
+                    results.append({'faultCode': 1,
+                                    'faultString': "%s:%s" % (exc_type, exc_value)})
+            else:
+                savepoint.commit()
+                results.append([result])
+        return results
+
+
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+
+class JSONRPCMixIn(object):
+    """
+    Serves the registered functions as JSON-RPC 2.0 on JSON_PATH, which
+    is much more compact than XML-RPC for the nested dicts we return.
+    Dates are sent as ISO 8601 strings. Batches go through
+    system.multicall, like with XML-RPC.
+    """
+
+    def _marshaled_dispatch(self, data, dispatch_method=None, path=None):
+        if path != JSON_PATH:
+            return SimpleXMLRPCDispatcher._marshaled_dispatch(
+                self, data, dispatch_method, path)
+
+        try:
+            request = json.loads(data)
+        except ValueError:
+            response = self._json_error(None, -32700, "Parse error")
+        else:
+            response = self._json_call(request)
+
+        try:
+            return json.dumps(response, default=_json_default,
+                              separators=(',', ':'))
+        except (TypeError, ValueError) as e:
+            return json.dumps(self._json_error(response.get('id'), -32603, str(e)))
+
+    def _json_call(self, request):
+        if not isinstance(request, dict) or 'method' not in request:
+            return self._json_error(None, -32600, "Invalid Request")
+
+        id = request.get('id')
+        params = request.get('params', [])
+        if not isinstance(params, list):
+            return self._json_error(id, -32602, "Invalid params")
+
+        try:
+            result = self._dispatch(request['method'], params)
+        except xmlrpclib.Fault as fault:
+            return self._json_error(id, fault.faultCode, fault.faultString)
+        except:
+            exc_type, exc_value, _ = sys.exc_info()
+            return self._json_error(id, 1, "%s:%s" % (exc_type, exc_value))
+
+        return {'jsonrpc': "2.0", 'id': id, 'result': result}
+
+    def _json_error(self, id, code, message):
+        return {'jsonrpc': "2.0", 'id': id,
+                'error': {'code': code, 'message': message}}
+
+
+class IdleConnections(threading.Thread):
+    """
+    Holds the kept-alive connections between two requests, so that they
+    don't hold a worker while idle: a connection is handed back to the
+    server once its next request comes in, or closed after `timeout`
+    seconds without one.
+    """
+
+    def __init__(self, server, timeout):
+        threading.Thread.__init__(self, name="xmlrpc-idle")
+        self.daemon = True
+        self.server = server
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.closed = False
+        self.poll = select.poll()
+        self.reader, self.writer = os.pipe()
+        self.poll.register(self.reader, select.POLLIN)
+
+    def add(self, request, client_address):
+        """
+        Watch `request` for its next request. Returns False, without
+        taking it, if too many connections are idle already.
+        """
+
+        with self.lock:
+            if self.closed or len(self.connections) >= MAX_IDLE:
+                return False
+            fd = request.fileno()
+            self.connections[fd] = (request, client_address,
+                                    time.time() + self.timeout)
+            self.poll.register(fd, select.POLLIN)
+        # Have poll() pick the new connection up.
+        os.write(self.writer, "x")
+        return True
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        os.write(self.writer, "x")
+
+    def run(self):
+        while True:
+            with self.lock:
+                deadlines = [x[2] for x in self.connections.values()]
+            timeout = None
+            if deadlines:
+                timeout = max(min(deadlines) - time.time(), 0) * 1000
+
+            try:
+                events = self.poll.poll(timeout)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                events = []
+
+            ready = []
+            expired = []
+            with self.lock:
+                for fd, event in events:
+                    if fd == self.reader:
+                        os.read(self.reader, 4096)
+                    elif fd in self.connections:
+                        ready.append(self.connections.pop(fd))
+                        self.poll.unregister(fd)
+
+                now = time.time()
+                for fd, connection in self.connections.items():
+                    if self.closed or connection[2] <= now:
+                        expired.append(self.connections.pop(fd))
+                        self.poll.unregister(fd)
+                closed = self.closed
+
+            for request, client_address, _ in ready:
+                self.server.resume_request(request, client_address)
+            for request, client_address, _ in expired:
+                self.server.shutdown_request(request)
+            if closed:
+                return
+
+
+class WorkerPoolMixIn(object):
+    """
+    Like SocketServer.ThreadingMixIn, but requests are handled by a fixed
+    number of threads, and when those and the backlog are all busy, new
+    connections are turned down right away with a 503 and a Retry-After
+    header rather than left waiting. Kept-alive connections wait for their
+    next request in IdleConnections, not in a worker.
+    """
+
+    def init_pool(self, workers, backlog, keep_alive):
+        self.pool = WorkerPool(workers, backlog, name="xmlrpc")
+        self.request_queue_size = backlog
+        self.exit_requested = False
+        self.idle = IdleConnections(self, keep_alive)
+        self.idle.start()
+
+    def process_request(self, request, client_address):
+        if not self.pool.submit(self.process_request_thread,
+                                request, client_address):
+            self.reject_request(request)
+
+    def resume_request(self, request, client_address):
+        # The next request on a kept-alive connection.
+        if not self.pool.submit(self.serve_request, request, client_address):
+            self.reject_request(request)
+
+    def prepare_request(self, request):
+        return request
+
+    def process_request_thread(self, request, client_address):
+        try:
+            request = self.prepare_request(request)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+        self.serve_request(request, client_address)
+
+    def serve_request(self, request, client_address):
+        keep_alive = False
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+            keep_alive = not handler.close_connection
+        except SystemExit:
+            # check_shutdown() found nothing left running, stop serving
+            # from the main thread.
+            self.exit_requested = True
+            threading.Thread(target=self.shutdown).start()
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            if not (keep_alive and self.idle.add(request, client_address)):
+                self.shutdown_request(request)
+
+    def reject_request(self, request):
+        try:
+            request.sendall(http_response(
+                503, headers=[("Retry-After", RETRY_AFTER)], keep_alive=False))
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def serve_forever(self, poll_interval=0.5):
+        SimpleXMLRPCServer.serve_forever(self, poll_interval)
+        if self.exit_requested:
+            raise SystemExit(0)
+
+    def server_close(self):
+        SimpleXMLRPCServer.server_close(self)
+        self.idle.close()
+
+
+class SimpleAuthXMLRPCServer(WorkerPoolMixIn, SavepointMulticallMixIn,
+                             JSONRPCMixIn, SimpleXMLRPCServer):
     def __init__(self, addr,
                  requestHandler=SimpleXMLRPCRequestHandler,
                  bind_and_activate=True,
-                 allow_none=False):
+                 allow_none=False, workers=WORKERS, backlog=BACKLOG,
+                 keep_alive=KEEP_ALIVE):
+        self.init_pool(workers, backlog, keep_alive)
         SimpleXMLRPCServer.__init__(self, addr,
                                     requestHandler=requestHandler,
                                     bind_and_activate=bind_and_activate,
                                     allow_none=allow_none)
 
 
-class SecureXMLRPCServer(SimpleXMLRPCServer):
+class SecureXMLRPCServer(WorkerPoolMixIn, SavepointMulticallMixIn,
+                         JSONRPCMixIn, SimpleXMLRPCServer):
     def __init__(
         self, addr, keyfile, certfile, ca_certs,
         requestHandler=SimpleXMLRPCRequestHandler, logRequests=True,
-        allow_none=False, encoding=None, bind_and_activate=True
+        allow_none=False, encoding=None, bind_and_activate=True,
+        workers=WORKERS, backlog=BACKLOG, keep_alive=KEEP_ALIVE
     ):
+        self.init_pool(workers, backlog, keep_alive)
         SimpleXMLRPCServer.__init__(self, addr,
                                     requestHandler=requestHandler,
                                     logRequests=logRequests,
@@ -154,20 +524,47 @@ class SecureXMLRPCServer(SimpleXMLRPCServer):
                                     encoding=encoding,
                                     bind_and_activate=False)
 
-        cert_reqs = (ssl.CERT_NONE if ca_certs is None
-                     else ssl.CERT_REQUIRED)
-        self.socket = ssl.wrap_socket(self.socket,
-                                      keyfile=keyfile, certfile=certfile,
-                                      ca_certs=ca_certs, cert_reqs=cert_reqs,
-                                      ssl_version=ssl.PROTOCOL_TLSv1)
+        # The listening socket stays plain: connections are wrapped by the
+        # worker handling them, so that a slow handshake only holds that
+        # worker, not the accept loop.
+        self.ssl_context = make_ssl_context(keyfile, certfile, ca_certs)
+        self.rejects = WorkerPool(1, backlog, name="xmlrpc-reject")
 
         if bind_and_activate:
             self.server_bind()
             self.server_activate()
 
+    def prepare_request(self, request):
+        request.settimeout(REQUEST_TIMEOUT)
+        request = self.ssl_context.wrap_socket(request, server_side=True,
+                                               do_handshake_on_connect=False)
+        request.do_handshake()
+        return request
+
+    def reject_request(self, request):
+        # A kept-alive connection already did its handshake.
+        if isinstance(request, ssl.SSLSocket):
+            WorkerPoolMixIn.reject_request(self, request)
+        # TLS clients can't read a plain text 503, and the handshake needed
+        # first is left to a thread of its own, not to the accept loop.
+        # When that one is busy too, the client is just disconnected.
+        elif not self.rejects.submit(self.reject_tls_request, request):
+            self.shutdown_request(request)
+
+    def reject_tls_request(self, request):
+        try:
+            request.settimeout(HANDSHAKE_TIMEOUT)
+            request = self.ssl_context.wrap_socket(request, server_side=True)
+        except socket.error:
+            self.shutdown_request(request)
+            return
+        WorkerPoolMixIn.reject_request(self, request)
+
 
 def serve(server_addr, port, auth_method,
-          keyfile=None, certfile=None, ssl_keyring=None, pgp_keyring=None):
+          keyfile=None, certfile=None, ssl_keyring=None, pgp_keyring=None,
+          reap_interval=10, engine='threaded', workers=WORKERS, backlog=BACKLOG,
+          metrics_addr='127.0.0.1', metrics_port=None, keep_alive=KEEP_ALIVE):
     logger = logging.getLogger('debile')
     logger.info("Serving on `{server_addr}' on port `{port}'".format(**locals()))
     logger.info("Authentication method: {0}".format(auth_method))
@@ -175,21 +572,42 @@ def serve(server_addr, port, auth_method,
         logger.info("Using keyfile=`{keyfile}', certfile=`{certfile}', "
                     "ssl_keyring=`{ssl_keyring}'".format(**locals()))
     logger.info("Using pgp_keyring=`{pgp_keyring}'".format(**locals()))
+    logger.info("Server engine: {0}".format(engine))
 
     server = None
-    if auth_method == 'simple':
+    if engine == 'event':
+        # Avoid a circular import, the event server reuses our helpers.
+        from debile.master.eventserver import EventXMLRPCServer
+        if auth_method == 'simple':
+            keyfile = certfile = ssl_keyring = None
+        server = EventXMLRPCServer((server_addr, port), keyfile, certfile,
+                                   ca_certs=ssl_keyring, workers=workers,
+                                   backlog=backlog, allow_none=True)
+
+    elif auth_method == 'simple':
         server = SimpleAuthXMLRPCServer((server_addr, port),
                                         requestHandler=SimpleAsyncXMLRPCServer,
-                                        allow_none=True)
+                                        allow_none=True, workers=workers,
+                                        backlog=backlog, keep_alive=keep_alive)
 
     else:
         server = SecureXMLRPCServer((server_addr, port), keyfile, certfile,
                                     ca_certs=ssl_keyring,
                                     requestHandler=AsyncXMLRPCServer,
-                                    allow_none=True)
+                                    allow_none=True, workers=workers,
+                                    backlog=backlog, keep_alive=keep_alive)
 
     server.register_introspection_functions()
+    server.register_multicall_functions()
     server.register_instance(DebileMasterInterface(ssl_keyring, pgp_keyring))
+
+    with session() as s:
+        names.load(s)
+
+    LeaseReaper(reap_interval).start()
+    if metrics_port is not None:
+        MetricsServer(metrics_addr, metrics_port).start()
+
     server.serve_forever()
 
 
@@ -232,4 +650,11 @@ def main(args, config):
           config['xmlrpc'].get('keyfile'),
           config['xmlrpc'].get('certfile'),
           config['keyrings'].get('ssl'),
-          config["keyrings"].get('pgp'))
+          config["keyrings"].get('pgp'),
+          config.get('leases', {}).get('reap_interval', 10),
+          config['xmlrpc'].get('engine', 'threaded'),
+          config['xmlrpc'].get('workers', WORKERS),
+          config['xmlrpc'].get('backlog', BACKLOG),
+          config['xmlrpc'].get('metrics_addr', '127.0.0.1'),
+          config['xmlrpc'].get('metrics_port'),
+          config['xmlrpc'].get('keep_alive', KEEP_ALIVE))
@@ -22,23 +22,157 @@ from debile.utils.config import get_config
 
 from contextlib import contextmanager
 from importlib import import_module
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+import threading
+import logging
+import time
 
 
 config = {}
 Session = sessionmaker()
+# Only bound if there is a database_replica, see replica_session()
+ReplicaSession = sessionmaker()
+# Resolved repo info of the groups, see Group.get_repo_info
+repo_info = {}
 fedmsg = None
 
+# Seconds between two logs of the connection pool statistics, and checkouts
+# waiting longer than SLOW_CHECKOUT seconds are logged right away.
+POOL_LOG_INTERVAL = 300
+SLOW_CHECKOUT = 1.0
+
+
+class PoolStats(object):
+    """
+    Counts the connection pool checkouts and the time spent waiting for
+    them, and logs it every now and then along with the pool status, to
+    help sizing the pool and the database server.
+    """
+
+    def __init__(self, interval=POOL_LOG_INTERVAL):
+        self.lock = threading.Lock()
+        self.interval = interval
+        self.checkouts = 0
+        self.wait = 0.0
+        self.max_wait = 0.0
+        self.logged_at = time.time()
+        self.logged_checkouts = 0
+        self.logged_wait = 0.0
+
+    def record(self, pool, wait):
+        logger = logging.getLogger('debile')
+        if wait > SLOW_CHECKOUT:
+            logger.warning("Waited %.1f seconds for a database connection; %s",
+                           wait, pool.status())
+
+        with self.lock:
+            self.checkouts += 1
+            self.wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+            now = time.time()
+            if now - self.logged_at < self.interval:
+                return
+            checkouts = self.checkouts - self.logged_checkouts
+            waited = self.wait - self.logged_wait
+            max_wait = self.max_wait
+            self.logged_at = now
+            self.logged_checkouts = self.checkouts
+            self.logged_wait = self.wait
+            self.max_wait = 0.0
+
+        logger.info("%d database connection checkouts, %.1f ms average and "
+                    "%.1f ms max wait; %s", checkouts,
+                    waited * 1000 / checkouts, max_wait * 1000, pool.status())
+
+
+pool_stats = PoolStats()
+
+
+class MonitoredQueuePool(QueuePool):
+    def _do_get(self):
+        start = time.time()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            pool_stats.record(self, time.time() - start)
+
 
 def _init_config(path):
     config.update(get_config(name="master.yaml", path=path))
+    repo_info.clear()
     return config
 
 
+def _ping_connection(dbapi_connection, connection_record, connection_proxy):
+    # Raising DisconnectionError makes the pool retry with a new connection
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except:
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+def _statement_timeout(timeout):
+    def set_timeout(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("SET statement_timeout = %d" % (timeout))
+        cursor.close()
+    return set_timeout
+
+
+def _sqlite_connect(dbapi_connection, connection_record):
+    # pysqlite begins transactions by itself, only before DML statements,
+    # so SAVEPOINTs don't work: leave it to SQLAlchemy, see _sqlite_begin.
+    dbapi_connection.isolation_level = None
+    # A no-op inside transactions.
+    dbapi_connection.execute("PRAGMA foreign_keys=ON")
+
+
+def _sqlite_begin(connection):
+    # Take the write lock right away: two transactions which both read
+    # before writing would otherwise fail with "database is locked".
+    connection.execute("BEGIN IMMEDIATE")
+
+
+def _create_engine(url, pool):
+    if not pool:
+        engine = create_engine(url, implicit_returning=False)
+    else:
+        engine = create_engine(url, implicit_returning=False,
+                               poolclass=MonitoredQueuePool,
+                               pool_size=pool.get('size', 5),
+                               max_overflow=pool.get('max_overflow', 10),
+                               pool_timeout=pool.get('timeout', 30),
+                               pool_recycle=pool.get('recycle', -1))
+
+        if pool.get('pre_ping', False):
+            event.listen(engine, "checkout", _ping_connection)
+        if pool.get('statement_timeout', None):
+            if engine.dialect.name != "postgresql":
+                raise ValueError("statement_timeout needs postgresql")
+            event.listen(engine, "connect",
+                         _statement_timeout(pool['statement_timeout']))
+
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", _sqlite_connect)
+        event.listen(engine, "begin", _sqlite_begin)
+
+    return engine
+
+
 def _init_sqlalchemy(config):
-    engine = create_engine(config['database'], implicit_returning=False)
-    Session.configure(bind=engine)
+    pool = config.get('database_pool', None)
+    Session.configure(bind=_create_engine(config['database'], pool))
+
+    if config.get('database_replica', None):
+        ReplicaSession.configure(
+            bind=_create_engine(config['database_replica'], pool))
 
 
 def _init_fedmsg(config):
@@ -71,10 +205,6 @@ def init_master(confpath=None, fedmsg=True):
 @contextmanager
 def session():
     session_ = Session()
-    if session_.get_bind().driver == "sqlite":
-        print("Explicitly enabling foreign keys in sqlite")
-        session_.execute("PRAGMA foreign_keys=ON")
-
     try:
         yield session_
         session_.commit()
@@ -85,6 +215,40 @@ def session():
         session_.close()
 
 
+@contextmanager
+def replica_session(primary=None):
+    """
+    A session on the database_replica, or None if there is none, or if the
+    `primary` session has changes the replica can't see yet (e.g. made
+    earlier in a system.multicall). It is meant for reads only, so it is
+    never committed.
+    """
+
+    if ReplicaSession.kw.get('bind') is None or (
+            primary is not None and (primary.info.get('flushed') or
+                                     primary.new or primary.dirty or
+                                     primary.deleted)):
+        yield None
+        return
+
+    session_ = ReplicaSession()
+    try:
+        yield session_
+    finally:
+        session_.close()
+
+
+@event.listens_for(Session, "after_flush")
+def _note_flush(session, flush_context):
+    session.info['flushed'] = True
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _forget_flush(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('flushed', None)
+
+
 def emit(topic, modname, message):
     # <topic_prefix>.<env>.<modname>.<topic>
     modname = "debile.%s" % (modname)
@@ -0,0 +1,70 @@
+# Copyright (c) 2026      agent <agent@local>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import Queue
+import threading
+import logging
+
+
+# Default number of worker threads, and of tasks which may wait for one.
+WORKERS = 16
+BACKLOG = 64
+
+
+class WorkerPool(object):
+    """
+    A fixed number of threads running submitted tasks, with a bounded queue
+    in front of them, so that a burst of requests can neither create an
+    unbounded number of threads (and database connections) nor pile up.
+    """
+
+    def __init__(self, size=WORKERS, backlog=BACKLOG, name="worker"):
+        self.size = size
+        self.tasks = Queue.Queue(maxsize=max(backlog, 1))
+        self.threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self._run,
+                                      name="%s-%d" % (name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, fn, *args):
+        """
+        Queue `fn(*args)` to be run by a worker. Returns False, without
+        queuing it, if the backlog is full.
+        """
+
+        try:
+            self.tasks.put_nowait((fn, args))
+        except Queue.Full:
+            return False
+        return True
+
+    def _run(self):
+        logger = logging.getLogger('debile')
+        while True:
+            fn, args = self.tasks.get()
+            try:
+                fn(*args)
+            except Exception:
+                logger.warning("Error in worker thread", exc_info=True)
+            finally:
+                self.tasks.task_done()
@@ -33,6 +33,7 @@ from firehose.model import (Analysis, Generator, Metadata,
 import sys
 import signal
 import logging
+import threading
 import time
 import os.path
 import shutil
@@ -45,6 +46,48 @@ class IDidNothingException(Exception):
     pass
 
 
+class LeaseLostException(Exception):
+    pass
+
+
+class LeaseRenewer(threading.Thread):
+    """
+    Keeps the lease on a job alive on the master while we work on it. If
+    the master says the job is no longer ours, the main thread is sent
+    SIGUSR2 so that it aborts the job, see lease_lost_handler.
+    """
+
+    def __init__(self, proxy, job_id, interval):
+        threading.Thread.__init__(self, name="lease-renewer")
+        self.daemon = True
+        self.proxy = proxy
+        self.job_id = job_id
+        self.interval = interval
+        self.finished = threading.Event()
+
+    def run(self):
+        logger = logging.getLogger('debile')
+        while not self.finished.wait(self.interval):
+            try:
+                renewed = self.proxy.renew_lease(self.job_id)
+            except:
+                logger.error("Error while renewing the lease on job id=%s",
+                             self.job_id, exc_info=True)
+                continue
+
+            if not renewed:
+                logger.warn("Lost the lease on job id=%s, aborting it",
+                            self.job_id)
+                if not self.finished.is_set():
+                    os.kill(os.getpid(), signal.SIGUSR2)
+                return
+
+    def stop(self):
+        # Wait for any running call, so the proxy is free again
+        self.finished.set()
+        self.join()
+
+
 def listize(entry):
     items = [x.strip() for x in entry.split(",")]
     return [None if x == "null" else x for x in items]
@@ -103,12 +146,16 @@ def checkout(package):
 
 
 @contextmanager
-def workon(proxy, suites, components, arches, capabilities):
+def workon(proxy, suites, components, arches, capabilities, renew_interval=60,
+           wait=0):
     logger = logging.getLogger('debile')
     logger.debug("Checking for new jobs")
 
     try:
-        job = proxy.get_next_job(suites, components, arches, capabilities)
+        if wait:
+            job = proxy.get_next_job(suites, components, arches, capabilities, wait)
+        else:
+            job = proxy.get_next_job(suites, components, arches, capabilities)
     except:
         logger.error("Error while requesting a job from the master", exc_info=True)
         raise
@@ -125,8 +172,19 @@ def workon(proxy, suites, components, arches, capabilities):
         job['suite'],
     )
 
+    renewer = LeaseRenewer(proxy, job['id'], renew_interval)
+    renewer.start()
+
     try:
-        yield job
+        try:
+            yield job
+        finally:
+            renewer.stop()
+    except LeaseLostException:
+        # Another builder may be running it by now, there is nothing to
+        # report nor to upload.
+        logger.warn("Aborted job id=%s, its lease was lost", job['id'])
+        raise
     except (SystemExit, KeyboardInterrupt):
         logger.info("Forfeiting the job because of shutdown request")
         try:
@@ -270,6 +328,10 @@ def shutdown_request_handler(signum, frame):
     shutdown_request = True
 
 
+def lease_lost_handler(signum, frame):
+    raise LeaseLostException()
+
+
 def main(args, config, proxy):
     start_logging(args)
 
@@ -286,15 +348,20 @@ def main(args, config, proxy):
 
     signal.signal(signal.SIGHUP,  signal.SIG_IGN)
     signal.signal(signal.SIGUSR1, shutdown_request_handler)
+    signal.signal(signal.SIGUSR2, lease_lost_handler)
 
     suites = config['suites']
     components = config['components']
     arches = config['arches']
     checks = config.get('checks', list(PLUGINS.keys()))
+    renew_interval = config.get('lease_renew_interval', 60)
+    poll_wait = config.get('poll_wait', 0)
 
     while True:
+        polled_at = time.time()
         try:
-            with workon(proxy, suites, components, arches, checks) as job:
+            with workon(proxy, suites, components, arches, checks,
+                        renew_interval, poll_wait) as job:
                 run_job(config, job)
             if shutdown_request:
                 raise SystemExit(0)
@@ -302,6 +369,18 @@ def main(args, config, proxy):
             raise SystemExit(1)
         except SystemExit:
             raise
+        except LeaseLostException:
+            if shutdown_request:
+                raise SystemExit(0)
+        except IDidNothingException:
+            if shutdown_request:
+                raise SystemExit(0)
+            # The master already held the poll for us when long-polling,
+            # unless too many builders were waiting already.
+            if poll_wait:
+                time.sleep(max(poll_wait - (time.time() - polled_at), 0))
+            else:
+                time.sleep(60)
         except:
             if shutdown_request:
                 raise SystemExit(0)
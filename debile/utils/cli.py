@@ -167,13 +167,14 @@ def _disable_user(proxy, email):
     print(proxy.disable_user(email))
 
 
-def _rerun_job(proxy, job_id):
+def _rerun_job(proxy, *job_ids):
     """
-    Re-runs a specified job:
-        debile-remote rerun-job <job-id>
+    Re-runs the specified jobs:
+        debile-remote rerun-job <job-id> [<job-id> ...]
     """
 
-    print(proxy.rerun_job(job_id))
+    for result in proxy.map("rerun_job", [(x,) for x in job_ids]):
+        print(result)
 
 
 def _rerun_check(proxy, name):
@@ -23,8 +23,11 @@
 
 from fnmatch import fnmatch
 
+import itertools
 import xmlrpclib
 import httplib
+import urllib
+import json
 import socket
 import ssl
 import os.path
@@ -46,12 +49,21 @@ def validate(cert, hostname):
     return False
 
 
+def make_ssl_context(key_file, cert_file, ca_certs):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+    context.load_cert_chain(cert_file, key_file)
+    if ca_certs is not None:
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_verify_locations(ca_certs)
+    return context
+
+
 class DebileHTTPSConnection(httplib.HTTPSConnection):
     def __init__(
         self, host, port=None,
         key_file=None, cert_file=None, ca_certs=None,
         strict=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
-        source_address=None
+        source_address=None, context=None, transport=None
     ):
         if not (os.path.isfile(cert_file) and os.access(cert_file, os.R_OK)):
             raise Exception("Could not find/access " + cert_file)
@@ -69,6 +81,8 @@ class DebileHTTPSConnection(httplib.HTTPSConnection):
             source_address=source_address
         )
         self.ca_certs = ca_certs
+        self.context = context
+        self.transport = transport
 
     def connect(self):
         sock = socket.create_connection(
@@ -79,14 +93,13 @@ class DebileHTTPSConnection(httplib.HTTPSConnection):
             self.sock = sock
             self._tunnel()
 
-        cert_reqs = (ssl.CERT_NONE if self.ca_certs is None
-                     else ssl.CERT_REQUIRED)
+        if self.context is None:
+            self.context = make_ssl_context(self.key_file, self.cert_file,
+                                            self.ca_certs)
+            if self.transport is not None:
+                self.transport.context = self.context
 
-        self.sock = ssl.wrap_socket(
-            sock, self.key_file, self.cert_file,
-            ca_certs=self.ca_certs, cert_reqs=cert_reqs,
-            do_handshake_on_connect=True, ssl_version=ssl.PROTOCOL_TLSv1,
-        )
+        self.sock = self.context.wrap_socket(sock)
 
         if not validate(self.sock.getpeercert(), self.host):
             raise Exception("https endpoint presented invalid certificate: "
@@ -101,6 +114,13 @@ class DebileSafeTransport(xmlrpclib.Transport):
         self.cert_file = cert_file
         self.ca_certs = ca_certs
 
+        # Shared by the successive connections, so that the keys and the CA
+        # bundle are only loaded once. TLS sessions can't be resumed with
+        # Python 2, instead the connection is kept alive between calls, so
+        # there is only one handshake until the master closes it (see its
+        # xmlrpc keep_alive setting).
+        self.context = None
+
     def make_connection(self, host):
         host = (host, {
             'key_file':  self.key_file,
@@ -112,35 +132,154 @@ class DebileSafeTransport(xmlrpclib.Transport):
             return self._connection[1]
 
         chost, self._extra_headers, x509 = self.get_host_info(host)
-        self._connection = host, DebileHTTPSConnection(chost, None, timeout=60, **(x509 or {}))
+        connection = DebileHTTPSConnection(chost, None, timeout=60,
+                                           context=self.context, transport=self,
+                                           **(x509 or {}))
+        self._connection = host, connection
 
         return self._connection[1]
 
 
+class BatchMixIn(object):
+    """
+    Helpers to send many calls in a single request, which the master runs
+    in a single transaction.
+    """
+
+    def batch(self):
+        """
+        Returns an xmlrpclib.MultiCall: make the calls on it, then call it
+        to send them all at once and iterate over the results.
+        """
+        return xmlrpclib.MultiCall(self)
+
+    def map(self, method, args_list, chunk=100):
+        """
+        Call `method` once with each of the argument tuples in `args_list`,
+        `chunk` calls per request. Returns the results in order, with an
+        xmlrpclib.Fault in place of each call which failed.
+        """
+
+        results = []
+        for i in range(0, len(args_list), chunk):
+            multicall = self.batch()
+            for args in args_list[i:i + chunk]:
+                getattr(multicall, method)(*args)
+            for result in multicall().results:
+                if isinstance(result, dict):
+                    result = xmlrpclib.Fault(result['faultCode'],
+                                             result['faultString'])
+                else:
+                    result = result[0]
+                results.append(result)
+        return results
+
+
+class DebileServerProxy(xmlrpclib.ServerProxy, BatchMixIn):
+    pass
+
+
+class JSONTransportMixIn:
+    """
+    Turns an xmlrpclib transport into a JSON-RPC one, keeping its
+    connection handling. Requests and responses are gzipped when large.
+    """
+
+    encode_threshold = 1400
+
+    def send_content(self, connection, request_body):
+        connection.putheader("Content-Type", "application/json")
+        if self.encode_threshold < len(request_body):
+            connection.putheader("Content-Encoding", "gzip")
+            request_body = xmlrpclib.gzip_encode(request_body)
+        connection.putheader("Content-Length", str(len(request_body)))
+        connection.endheaders(request_body)
+
+    def parse_response(self, response):
+        stream = response
+        if response.getheader("Content-Encoding", "") == "gzip":
+            stream = xmlrpclib.GzipDecodedResponse(response)
+        data = stream.read()
+        if stream is not response:
+            stream.close()
+        return json.loads(data)
+
+
+class JSONTransport(JSONTransportMixIn, xmlrpclib.Transport):
+    pass
+
+
+class JSONSafeTransport(JSONTransportMixIn, DebileSafeTransport):
+    pass
+
+
+class JSONRPCProxy(BatchMixIn):
+    """
+    Like xmlrpclib.ServerProxy, but talks JSON-RPC 2.0 to the master's
+    JSON endpoint, which is much more compact. Dates come back as ISO 8601
+    strings. Errors are raised as xmlrpclib.Fault.
+    """
+
+    def __init__(self, uri, transport):
+        _, rest = urllib.splittype(uri)
+        self._host, self._handler = urllib.splithost(rest)
+        self._transport = transport
+        self._ids = itertools.count(1)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return xmlrpclib._Method(self._request, name)
+
+    def _request(self, method, params):
+        request = json.dumps({
+            'jsonrpc': "2.0",
+            'id': next(self._ids),
+            'method': method,
+            'params': list(params),
+        }, separators=(',', ':'))
+
+        response = self._transport.request(self._host, self._handler, request)
+        if response.get('error') is not None:
+            raise xmlrpclib.Fault(response['error']['code'],
+                                  response['error']['message'])
+        return response['result']
+
+
 def get_proxy(config, auth_method):
     xml = config.get("xmlrpc", None)
     if xml is None:
         raise Exception("No xmlrpc found in slave yaml")
 
+    # `xmlrpc' or `json', see JSONRPCProxy
+    use_json = xml.get('protocol', 'xmlrpc') == 'json'
+
     proxy = None
     if auth_method == 'simple':
-        proxy = xmlrpclib.ServerProxy(
-            "http://{host}:{port}/".format(
-                host=xml['host'],
-                port=xml['port'],
-            ),
-            allow_none=True)
+        url = "http://{host}:{port}/".format(
+            host=xml['host'],
+            port=xml['port'],
+        )
+        if use_json:
+            proxy = JSONRPCProxy(url + "json", JSONTransport())
+        else:
+            proxy = DebileServerProxy(url, allow_none=True)
 
     else:
-        proxy = xmlrpclib.ServerProxy(
-            "https://{host}:{port}/".format(
-                host=xml['host'],
-                port=xml['port'],
-            ), transport=DebileSafeTransport(
-                key_file=xml.get('keyfile', None),
-                cert_file=xml.get('certfile', None),
-                ca_certs=xml.get('ca_certs', "/etc/ssl/certs/ca-certificates.crt")
-            ), allow_none=True)
+        url = "https://{host}:{port}/".format(
+            host=xml['host'],
+            port=xml['port'],
+        )
+        transport = JSONSafeTransport if use_json else DebileSafeTransport
+        transport = transport(
+            key_file=xml.get('keyfile', None),
+            cert_file=xml.get('certfile', None),
+            ca_certs=xml.get('ca_certs', "/etc/ssl/certs/ca-certificates.crt")
+        )
+        if use_json:
+            proxy = JSONRPCProxy(url + "json", transport)
+        else:
+            proxy = DebileServerProxy(url, transport=transport, allow_none=True)
     return proxy
 
 
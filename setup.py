@@ -47,7 +47,9 @@ flavors = {
         'console_scripts': [
             'debile-master = debile.master.cli:server',
             'debile-master-init = debile.master.cli:init',
+            'debile-master-migrate = debile.master.cli:migrate',
             'debile-incoming = debile.master.cli:process_incoming',
+            'debile-master-benchmark = debile.master.cli:benchmark',
         ],
     }),  # Master config
 }
@@ -0,0 +1,37 @@
+from debile.master.metrics import MethodMetrics
+
+import unittest
+
+
+class MasterMetricsTestCase(unittest.TestCase):
+    def test_measure(self):
+        metrics = MethodMetrics()
+
+        with metrics.measure('get_next_job'):
+            pass
+
+        try:
+            with metrics.measure('get_next_job'):
+                raise Exception("You can't do that")
+        except Exception:
+            pass
+
+        stats = metrics.methods['get_next_job']
+        self.assertEquals(stats.calls, 2)
+        self.assertEquals(stats.errors, 1)
+        self.assertEquals(sum(stats.buckets), 2)
+
+
+    def test_render(self):
+        metrics = MethodMetrics()
+
+        with metrics.measure('close_job'):
+            pass
+
+        text = metrics.render()
+
+        self.assertIn('debile_rpc_calls_total{method="close_job"} 1\n', text)
+        self.assertIn('debile_rpc_errors_total{method="close_job"} 0\n', text)
+        self.assertIn('debile_rpc_duration_seconds_bucket{method="close_job",le="+Inf"} 1\n', text)
+        self.assertIn('debile_rpc_duration_seconds_count{method="close_job"} 1\n', text)
+        self.assertIn('# TYPE debile_rpc_duration_seconds histogram\n', text)
@@ -1,5 +1,8 @@
 import debile.master.utils as utils
 
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
 import unittest
 import mock
 
@@ -28,4 +31,57 @@ class MasterUtilsTestCase(unittest.TestCase):
         args, kwargs = mock_engine.call_args
 
         self.assertEquals(args, ('sqlite:////srv/debile/debile.db',))
-        self.assertFalse(kwargs['implicit_returning']) 
+        self.assertFalse(kwargs['implicit_returning'])
+        self.assertNotIn('pool_size', kwargs)
+
+
+    @mock.patch('debile.master.utils.event.listen')
+    @mock.patch('debile.master.utils.create_engine')
+    @mock.patch('debile.master.utils.Session.configure')
+    def test_init_sqlalchemy_pool(self, mock_configure, mock_engine, mock_listen):
+        config = {'database':'sqlite:////srv/debile/debile.db',
+                  'database_pool': {'size': 20, 'pre_ping': True}}
+
+        utils._init_sqlalchemy(config)
+
+        args, kwargs = mock_engine.call_args
+
+        self.assertEquals(kwargs['pool_size'], 20)
+        self.assertEquals(kwargs['max_overflow'], 10)
+        self.assertEquals(kwargs['poolclass'], utils.MonitoredQueuePool)
+        mock_listen.assert_called_once_with(mock_engine.return_value,
+                                            "checkout", utils._ping_connection)
+
+
+    @mock.patch('debile.master.utils.create_engine')
+    @mock.patch('debile.master.utils.Session.configure')
+    @mock.patch('debile.master.utils.ReplicaSession.configure')
+    def test_init_sqlalchemy_replica(self, mock_replica, mock_configure, mock_engine):
+        config = {'database':'sqlite:////srv/debile/debile.db',
+                  'database_replica':'sqlite:////srv/debile/replica.db'}
+
+        utils._init_sqlalchemy(config)
+
+        self.assertTrue(mock_replica.called)
+        args, kwargs = mock_engine.call_args
+        self.assertEquals(args, ('sqlite:////srv/debile/replica.db',))
+
+
+    def test_replica_session_without_replica(self):
+        with utils.replica_session() as s:
+            self.assertIsNone(s)
+
+
+    def test_replica_session_with_changes(self):
+        utils.ReplicaSession.configure(bind=create_engine('sqlite://'))
+        primary = sessionmaker()()
+        try:
+            with utils.replica_session(primary) as s:
+                self.assertIsNotNone(s)
+
+            # As if the primary session had flushed changes
+            primary.info['flushed'] = True
+            with utils.replica_session(primary) as s:
+                self.assertIsNone(s)
+        finally:
+            utils.ReplicaSession.configure(bind=None)
@@ -0,0 +1,72 @@
+from debile.master.workers import WorkerPool
+from debile.master.server import SimpleAuthXMLRPCServer, RETRY_AFTER
+
+import threading
+import socket
+import unittest
+
+
+class WorkerPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+
+    def busy_pool(self, pool):
+        # Holds the only worker, then fills the backlog.
+        started = threading.Event()
+
+        def block():
+            started.set()
+            self.release.wait(5)
+
+        self.assertTrue(pool.submit(block))
+        self.assertTrue(started.wait(5))
+        self.assertTrue(pool.submit(self.release.wait, 5))
+
+
+    def test_submit(self):
+        pool = WorkerPool(1, 1)
+        done = threading.Event()
+
+        self.assertTrue(pool.submit(done.set))
+        self.assertTrue(done.wait(5))
+
+
+    def test_backlog_full(self):
+        pool = WorkerPool(1, 1)
+        self.busy_pool(pool)
+
+        self.assertFalse(pool.submit(lambda: None))
+
+        self.release.set()
+        pool.tasks.join()
+        self.assertTrue(pool.submit(lambda: None))
+
+
+    def test_reject_request(self):
+        server = SimpleAuthXMLRPCServer(('127.0.0.1', 0), workers=1, backlog=1)
+        try:
+            self.busy_pool(server.pool)
+
+            client = socket.create_connection(server.socket.getsockname())
+            client.settimeout(5)
+            try:
+                server.handle_request()
+
+                response = ""
+                while True:
+                    data = client.recv(4096)
+                    if not data:
+                        break
+                    response += data
+            finally:
+                client.close()
+        finally:
+            server.server_close()
+
+        lines = response.split("\r\n")
+        self.assertEquals(lines[0], "HTTP/1.1 503 Service Unavailable")
+        self.assertIn("Retry-After: %d" % (RETRY_AFTER), lines)
+        self.assertIn("Connection: close", lines)
@@ -50,3 +50,27 @@ def test_repo_props():
     assert g.files_url == "http://localhost/debile/files/foo"
 
     config['repo'] = c
+
+
+resolved = []
+
+
+def counting_resolver(group, conf):
+    resolved.append(group)
+    return {"repo_path": "/srv/%s" % (group.name), "repo_url": "bar"}
+
+
+def test_repo_info_cache():
+    c = config['repo']
+    config['repo'] = {
+        "custom_resolver": "%s.counting_resolver" % (__name__)
+    }
+    assert g.repo_path == "/srv/foo"
+    assert g.repo_url == "bar"
+    assert len(resolved) == 1
+
+    config['repo'] = dict(config['repo'])
+    assert g.repo_path == "/srv/foo"
+    assert len(resolved) == 2
+
+    config['repo'] = c
@@ -0,0 +1,53 @@
+from debile.slave.daemon import (workon, lease_lost_handler,
+                                 LeaseLostException)
+
+import signal
+import time
+import unittest
+
+
+class FakeProxy(object):
+    def __init__(self, renew):
+        self.renew = renew
+        self.calls = []
+
+    def get_next_job(self, *args):
+        return {'id': 1, 'source': 'foo', 'name': 'lintian [amd64]',
+                'suite': 'unstable', 'failed': False}
+
+    def renew_lease(self, job_id):
+        self.calls.append('renew_lease')
+        return self.renew
+
+    def close_job(self, job_id, failed):
+        self.calls.append('close_job')
+
+    def forfeit_job(self, job_id):
+        self.calls.append('forfeit_job')
+
+
+class WorkonTestCase(unittest.TestCase):
+    def setUp(self):
+        self.handler = signal.signal(signal.SIGUSR2, lease_lost_handler)
+
+    def tearDown(self):
+        signal.signal(signal.SIGUSR2, self.handler)
+
+    def work(self, proxy, duration):
+        with workon(proxy, ['unstable'], ['main'], ['amd64'], ['lintian'],
+                    renew_interval=0.05):
+            deadline = time.time() + duration
+            while time.time() < deadline:
+                time.sleep(0.01)
+
+    def test_renewed(self):
+        proxy = FakeProxy(True)
+        self.work(proxy, 0.2)
+        self.assertIn('renew_lease', proxy.calls)
+        self.assertEquals(proxy.calls[-1], 'close_job')
+
+    def test_lease_lost(self):
+        proxy = FakeProxy(False)
+        self.assertRaises(LeaseLostException, self.work, proxy, 5)
+        # The job is someone else's now: neither closed nor forfeited
+        self.assertEquals(proxy.calls, ['renew_lease'])
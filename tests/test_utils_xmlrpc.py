@@ -1,5 +1,6 @@
 from debile.utils.xmlrpc import get_proxy
-from debile.utils.xmlrpc import DebileSafeTransport
+from debile.utils.xmlrpc import DebileSafeTransport, DebileServerProxy
+from debile.utils.xmlrpc import JSONRPCProxy, JSONSafeTransport
 
 import xmlrpclib
 import unittest
@@ -31,3 +32,26 @@ class UtilsXMLRPCTestCase(unittest.TestCase):
         self.assertTrue(proxy.__dict__['_ServerProxy__allow_none'])
         self.assertIsInstance(proxy.__dict__['_ServerProxy__transport'],
                 DebileSafeTransport)
+
+
+    def test_get_proxy_batch(self):
+        data = dict(xmlrpc = dict(host='localhost', port='22017'))
+
+        proxy = get_proxy(data, 'simple')
+
+        self.assertIsInstance(proxy, DebileServerProxy)
+        self.assertIsInstance(proxy.batch(), xmlrpclib.MultiCall)
+        self.assertEquals(proxy.map('rerun_job', []), [])
+
+
+    def test_get_proxy_json(self):
+        data = dict(xmlrpc = dict(host='localhost', port='22017',
+            keyfile='~/keyfile.key', certfile='~/certfile.crt',
+            protocol='json'))
+
+        proxy = get_proxy(data, 'ssl')
+
+        self.assertIsInstance(proxy, JSONRPCProxy)
+        self.assertEquals(proxy._host, 'localhost:22017')
+        self.assertEquals(proxy._handler, '/json')
+        self.assertIsInstance(proxy._transport, JSONSafeTransport)